@@ -10,6 +10,7 @@ from documents_page import documents_page
 from settings_page import settings_page
 from supabase_client import supabase, handle_auth_failure
 from auth_utils import sign_out
+from face_extraction import start_background_warm_up
 import datetime
 
 def initialize_session_state():
@@ -103,6 +104,7 @@ def main():
         page_icon="🔒"
     )
     initialize_session_state()
+    start_background_warm_up()
     if st.session_state.supabase_session and not verify_session():
         return
     if not st.session_state.user_email or not st.session_state.supabase_session:
@@ -1,16 +1,101 @@
 """Extracts information and faces from the documents, saves the faces in supabase storage and the extracted information in the session state"""
 import streamlit as st
-from document_information import configuration, extract_document_details
+from document_information import configuration, extract_document_details, merge_page_details
+from extraction_cache import extraction_cache
 from supabase_client import supabase
 import os
-import tempfile
 from datetime import datetime
 from document_utils import get_user_documents
-from face_extraction import faceextractor
+from face_extraction import submit_document_faces, collect_document_faces
+from image_utils import iter_document_images
 from photo_utils import upload_picture
 from io import BytesIO
 from profile_utils import get_user_profile
-from verification import verify_doc
+from verification import verify_doc, verify_docs_batch
+from verification_rules import LOCAL_RULES_ENABLED, RuleStats, rule_stats
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DOCUMENT_PIPELINE_WORKERS = int(os.getenv("DOCUMENT_PIPELINE_WORKERS", "4"))
+DOCUMENT_VERIFY_MODE = os.getenv("DOCUMENT_VERIFY_MODE", "batch")
+
+def extract_document(file_content):
+    """Run the LLM extraction on every page of a document, PDFs are rendered one page at a time"""
+    details = merge_page_details([extract_document_details(page) for page in iter_document_images(file_content)])
+    print(f"Debug: Extraction cache stats: {extraction_cache.stats()}")
+    return details
+
+def verification_input(doc_type, extracted_data, expiry_info):
+    """The document fields verify_doc compares against the user profile"""
+    return {
+        "document_info": {
+            "website_document_type":doc_type,
+            "document_type": extracted_data.get("document_type"),
+            "document_number": extracted_data.get("document_number"),
+            "name": extracted_data.get("name"),
+            "date_of_birth": extracted_data.get("dob")
+        },
+        "additional_info": {
+            "sex": extracted_data.get("sex"),
+            "relative_name": extracted_data.get("relative_name"),
+            "address": extracted_data.get("address"),
+            "phone": extracted_data.get("phone")
+        },
+        "expiry_info": expiry_info
+    }
+
+def process_document(doc, user_id, profile, verify=True, rule_counts=None):
+    """
+    Download, extract and verify one document on a pipeline thread.
+
+    Its face extraction runs on the process pool while the LLM extraction and verification calls
+    are in flight. With verify=False the verify_doc call is left out and the outcome carries the
+    'verification_input' for a batch verification. rule_counts collects the local rule decisions of
+    this run. Nothing here calls streamlit, the outcome is returned for the page to report.
+    """
+    doc_type = doc['document_type']
+    outcome = {'final_result': None, 'validity': None, 'verification_input': None, 'face_result': None, 'error': None, 'exception': None}
+    try:
+        file_content = supabase.storage.from_("user-documents").download(doc['file_path'])
+    except Exception as e:
+        outcome['error'] = f"Error downloading {doc_type}: {str(e)}"
+        outcome['exception'] = str(e)
+        return outcome
+
+    face_job = None
+    try:
+        existing_faces = supabase.table('user_pictures').select('*').eq('user_id', user_id).eq('document_type', doc_type).execute()
+        if not existing_faces.data:
+            face_job = submit_document_faces(file_content)
+
+        extracted_data = extract_document(file_content)
+
+        final_result = {
+            "timestamp": datetime.now().isoformat(),
+            "document_data": extracted_data if extracted_data else {},
+            "expiry_info": extracted_data.get("expiry_info", {
+                "expiry_date": None,
+                "is_near_expiry": False
+            }) if extracted_data else {
+                "expiry_date": None,
+                "is_near_expiry": False
+            }
+        }
+
+        if not extracted_data:
+            outcome['validity'] = "ERROR: No extracted data"
+        else:
+            outcome['verification_input'] = verification_input(doc_type, extracted_data, final_result["expiry_info"])
+            if verify:
+                outcome['validity'] = verify_doc(outcome['verification_input'], profile, rule_counts)
+        outcome['final_result'] = final_result
+    except Exception as e:
+        outcome['error'] = f"Error processing {doc_type}: {str(e)}"
+        outcome['exception'] = str(e)
+    finally:
+        if face_job is not None:
+            outcome['face_result'] = collect_document_faces(face_job)
+    return outcome
+
 def document_extraction_page():
     configuration()
     if not st.session_state.get('documents_uploaded', False):
@@ -36,79 +121,63 @@ def document_extraction_page():
        
         with st.spinner("Extracting and verifying all documents..."):
             progress_bar = st.progress(0)
+            progress_text = st.empty()
             total_docs = len(existing_docs)
-           
-            for i, doc in enumerate(existing_docs):
-                try:
-                    progress_bar.progress((i + 1) / total_docs)
-                   
-                    file_path = doc['file_path']
-                    file_content = supabase.storage.from_("user-documents").download(file_path)
-                   
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file_path)[1]) as temp_file:
-                        temp_file.write(file_content)
-                        temp_file_path = temp_file.name
-                   
-                    extracted_data = extract_document_details(temp_file_path)
-                    
-                    doc_type = doc['document_type']
-                    
-                    existing_faces = supabase.table('user_pictures').select('*').eq('user_id', user_id).eq('document_type', doc_type).execute()
-                    
-                    if not existing_faces.data:  
-                        faces = faceextractor(temp_file_path)
-                        if faces:
-                            extracted_faces.append({
-                                'type': doc_type,
-                                'data': faces[0]  
-                            })
-                            existing_face_types.add(doc_type)
-                    
-                    final_result = {
-                        "timestamp": datetime.now().isoformat(),
-                        "document_data": extracted_data if extracted_data else {},
-                        "expiry_info": extracted_data.get("expiry_info", {
-                            "expiry_date": None,
-                            "is_near_expiry": False
-                        }) if extracted_data else {
-                            "expiry_date": None,
-                            "is_near_expiry": False
-                        }
-                    }
-                    
-                    profile = get_user_profile(st.session_state.user_email)
-                    validity = "ERROR: No extracted data" if not extracted_data else verify_doc({
-                        "document_info": {
-                            "website_document_type":doc_type,
-                            "document_type": extracted_data.get("document_type"),
-                            "document_number": extracted_data.get("document_number"),
-                            "name": extracted_data.get("name"),
-                            "date_of_birth": extracted_data.get("dob")
-                        },
-                        "additional_info": {
-                            "sex": extracted_data.get("sex"),
-                            "relative_name": extracted_data.get("relative_name"),
-                            "address": extracted_data.get("address"),
-                            "phone": extracted_data.get("phone")
-                        },
-                        "expiry_info": final_result["expiry_info"]
-                    }, profile)
-
-                    verification_results[doc_type] = validity
-                    if validity and "INVALID" in validity:
-                        verification_status = False
-                        error_messages.append(f"{doc_type}: {validity}")
-                    
-                    all_extracted_data[doc_type] = final_result
-                    
-                    os.unlink(temp_file_path)
-                
-                except Exception as e:
-                    st.error(f"Error processing {doc['document_type']}: {str(e)}")
+            profile = get_user_profile(st.session_state.user_email)
+            outcomes = [None] * total_docs
+            rule_counts = RuleStats()
+            batch_verify = DOCUMENT_VERIFY_MODE == "batch"
+
+            with ThreadPoolExecutor(max_workers=max(1, min(DOCUMENT_PIPELINE_WORKERS, total_docs))) as pool:
+                futures = {pool.submit(process_document, doc, user_id, profile, not batch_verify, rule_counts): i for i, doc in enumerate(existing_docs)}
+                for done, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    outcomes[i] = future.result()
+                    progress_bar.progress(done / total_docs)
+                    progress_text.write(f"Processed {existing_docs[i]['document_type']} ({done}/{total_docs})")
+
+            if batch_verify:
+                pending = [i for i, outcome in enumerate(outcomes) if not outcome['error'] and outcome['verification_input'] is not None]
+                if pending:
+                    progress_text.write("Verifying all documents against your profile...")
+                    verdicts = verify_docs_batch([outcomes[i]['verification_input'] for i in pending], profile, rule_counts)
+                    for i, verdict in zip(pending, verdicts):
+                        outcomes[i]['validity'] = verdict
+
+            if LOCAL_RULES_ENABLED:
+                avoided = rule_counts.avoided_percentage()
+                print(f"Debug: Local verification rules avoided {avoided:.0f}% of verification calls, {rule_stats.decided} decided and {rule_stats.deferred} deferred overall")
+                progress_text.write(f"{avoided:.0f}% of document checks were decided locally without calling Gen-AI")
+
+            for doc, outcome in zip(existing_docs, outcomes):
+                doc_type = doc['document_type']
+                if outcome['error']:
+                    st.error(outcome['error'])
                     verification_status = False
-                    verification_results[doc['document_type']] = f"ERROR: {str(e)}"
-                    error_messages.append(f"{doc['document_type']}: {str(e)}")
+                    verification_results[doc_type] = f"ERROR: {outcome['exception']}"
+                    error_messages.append(f"{doc_type}: {outcome['exception']}")
                     continue
+
+                face_result = outcome['face_result']
+                if face_result:
+                    if face_result['error']:
+                        error_messages.append(f"{doc_type}: Face extraction failed: {face_result['error']}")
+                    elif face_result['faces']:
+                        faces = face_result['faces']
+                        extracted_faces.append({
+                            'type': doc_type,
+                            'data': faces[0]['image'],
+                            'embedding': faces[0]['embedding']
+                        })
+                        existing_face_types.add(doc_type)
+
+                validity = outcome['validity']
+                verification_results[doc_type] = validity
+                if validity and "INVALID" in validity:
+                    verification_status = False
+                    error_messages.append(f"{doc_type}: {validity}")
+
+                all_extracted_data[doc_type] = outcome['final_result']
                 
         if extracted_faces:
             with st.spinner("Uploading extracted faces..."):
@@ -143,7 +212,8 @@ def document_extraction_page():
                         upload_result = upload_picture(
                             user_id=user_id,
                             document_type=doc_type,
-                            file=uploaded_file
+                            file=uploaded_file,
+                            embedding=face_info.get('embedding')
                         )
                         
                         if not upload_result:
@@ -3,10 +3,50 @@ import json
 import os
 from datetime import datetime, timedelta
 import google.generativeai as genai
+import numpy as np
 from PIL import Image
+from io import BytesIO
+from image_utils import read_image_bytes, image_mime_type, to_pil_image
+from extraction_cache import extraction_cache, image_digest
+import hashlib
 import os
 from dotenv import load_dotenv
 load_dotenv(".env")
+
+EXTRACTION_MODEL = 'gemini-1.5-flash'
+EXTRACTION_PROMPT = """
+        Classify this Indian document into one of these types:
+        - Indian Passport (alphanumeric on the top right, below "Passport no.", "Republic of India" on top, two images of holder)
+        - Indian PAN Card (10-digit alphanumeric, "INCOME TAX DEPARTMENT" top left, QR code/ metallic square on the right)
+        - Occluded Indian Aadhar Card (4 digit number with the first 8 digits occluded located above the VID number, UDAI logo, horizontal line extending below the VID number)
+        - Indian Aadhaar Card (12-digit located above VID number, UIDAI logo, horizontal line extending below the VID number)
+        - Back Aadhaar Card (12 digit number, QR code on the right with address to the left, UDAI logo, horizontal line extending at the bottom)
+        - Indian Driving License (alphanumeric below the Issued by state RTO, picture located to the right side, top right sybol for state)
+        - Indian Voter ID (vertical, Election Comission of India on top, UID after Bar code)
+
+        Analyze this Indian document and extract the following information in JSON format:
+        {
+            "document_type": "",  # Classify as given above
+            "document_number": "",  # The full document number
+            "name": "",  # Full name of the document holder
+            "dob": "",  # Date of birth in YYYY-MM-DD format
+            "sex": "",  # Gender if available
+            "relative_name": "",  # Father/Mother/Spouse name
+            "address": "",  # Complete address
+            "phone": "",  # Phone number
+            "date_of_expiry": "",  # Expiry date in YYYY-MM-DD format if available
+            "validity": ""  # Alternative field for expiry/validity date
+        }
+
+        Rules:
+        1. Return ONLY the JSON structure with the extracted values
+        2. If any field is not available in the document, set it to null
+        3. For dates, always use YYYY-MM-DD format when possible
+        4. Include both date_of_expiry and validity fields if found
+        5. Be extremely accurate - don't hallucinate any details
+        """
+EXTRACTION_VERSION = hashlib.sha256(f"{EXTRACTION_MODEL}\n{EXTRACTION_PROMPT}".encode("utf-8")).hexdigest()[:16]
+
 def configuration():
     fetched_api_key = os.getenv("GOOGLE_API_KEY")
     genai.configure(api_key=fetched_api_key)
@@ -42,44 +82,37 @@ def extract_expiry_date(document_data):
         print(f"Error processing expiry date: {str(e)}")
         return None, None
 
-def extract_document_details(image_path):
-    """Classify the document and extract key fields including expiry date"""
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        prompt = """
-        Classify this Indian document into one of these types:
-        - Indian Passport (alphanumeric on the top right, below "Passport no.", "Republic of India" on top, two images of holder)
-        - Indian PAN Card (10-digit alphanumeric, "INCOME TAX DEPARTMENT" top left, QR code/ metallic square on the right)
-        - Occluded Indian Aadhar Card (4 digit number with the first 8 digits occluded located above the VID number, UDAI logo, horizontal line extending below the VID number)
-        - Indian Aadhaar Card (12-digit located above VID number, UIDAI logo, horizontal line extending below the VID number)
-        - Back Aadhaar Card (12 digit number, QR code on the right with address to the left, UDAI logo, horizontal line extending at the bottom)
-        - Indian Driving License (alphanumeric below the Issued by state RTO, picture located to the right side, top right sybol for state)
-        - Indian Voter ID (vertical, Election Comission of India on top, UID after Bar code)
+def image_content_part(image_source):
+    """Build the image part of the request, encoded JPEG/PNG/WebP bytes are sent as-is without being decoded"""
+    if isinstance(image_source, Image.Image):
+        return image_source
+    if isinstance(image_source, np.ndarray):
+        return to_pil_image(image_source)
+    data = read_image_bytes(image_source)
+    mime_type = image_mime_type(data)
+    if mime_type:
+        return {"mime_type": mime_type, "data": data}
+    return Image.open(BytesIO(data))
 
-        Analyze this Indian document and extract the following information in JSON format:
-        {
-            "document_type": "",  # Classify as given above
-            "document_number": "",  # The full document number
-            "name": "",  # Full name of the document holder
-            "dob": "",  # Date of birth in YYYY-MM-DD format
-            "sex": "",  # Gender if available
-            "relative_name": "",  # Father/Mother/Spouse name
-            "address": "",  # Complete address
-            "phone": "",  # Phone number
-            "date_of_expiry": "",  # Expiry date in YYYY-MM-DD format if available
-            "validity": ""  # Alternative field for expiry/validity date
-        }
+def extract_document_details(image_source):
+    """Classify the document and extract key fields including expiry date.
+    image_source can be a file path, image bytes or buffer, a decoded BGR array or a PIL image.
+    Results are cached by image digest and EXTRACTION_VERSION, the expiry check is redone on every call."""
+    try:
+        if not isinstance(image_source, (np.ndarray, Image.Image)):
+            image_source = read_image_bytes(image_source)
+        cache_key = f"{image_digest(image_source)}:{EXTRACTION_VERSION}"
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            expiry_date, is_near_expiry = extract_expiry_date(cached)
+            cached["expiry_info"] = {
+                "expiry_date": expiry_date,
+                "is_near_expiry": is_near_expiry
+            }
+            return cached
 
-        Rules:
-        1. Return ONLY the JSON structure with the extracted values
-        2. If any field is not available in the document, set it to null
-        3. For dates, always use YYYY-MM-DD format when possible
-        4. Include both date_of_expiry and validity fields if found
-        5. Be extremely accurate - don't hallucinate any details
-        """
-        
-        img = Image.open(image_path)
-        response = model.generate_content([prompt, img])
+        model = genai.GenerativeModel(EXTRACTION_MODEL)
+        response = model.generate_content([EXTRACTION_PROMPT, image_content_part(image_source)])
         
         try:
             json_str = response.text.strip().replace('```json', '').replace('```', '').strip()
@@ -97,6 +130,8 @@ def extract_document_details(image_path):
                 elif data[field] == "":
                     data[field] = None
             
+            extraction_cache.put(cache_key, data)
+
             expiry_date, is_near_expiry = extract_expiry_date(data)
             data["expiry_info"] = {
                 "expiry_date": expiry_date,
@@ -143,6 +178,27 @@ def extract_document_details(image_path):
             "error": str(e)
         }
 
+def merge_page_details(page_results):
+    """Combine the details extracted from each page of a multi-page document, the first page with a value wins for every field"""
+    if not page_results:
+        return None
+    if len(page_results) == 1:
+        return page_results[0]
+
+    usable = [data for data in page_results if not data.get("error")] or page_results
+    merged = dict(usable[0])
+    for data in usable[1:]:
+        for field, value in data.items():
+            if field != "expiry_info" and merged.get(field) is None and value is not None:
+                merged[field] = value
+
+    expiry_date, is_near_expiry = extract_expiry_date(merged)
+    merged["expiry_info"] = {
+        "expiry_date": expiry_date,
+        "is_near_expiry": is_near_expiry
+    }
+    return merged
+
 def save_to_json(data, filename='document_data.json'):
     """Save extracted data to JSON file"""
     try:
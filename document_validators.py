@@ -0,0 +1,107 @@
+"""Offline format checks of Indian document numbers, the Verhoeff checksum of Aadhaar and the structure of PAN, passport, driving licence and voter ID numbers."""
+import re
+
+VERHOEFF_MULTIPLICATION = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 2, 3, 4, 0, 6, 7, 8, 9, 5),
+    (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7),
+    (4, 0, 1, 2, 3, 9, 5, 6, 7, 8),
+    (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2),
+    (7, 6, 5, 9, 8, 2, 1, 0, 4, 3),
+    (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0)
+)
+VERHOEFF_PERMUTATION = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 5, 7, 6, 2, 8, 3, 0, 9, 4),
+    (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7),
+    (9, 4, 5, 3, 1, 2, 6, 8, 7, 0),
+    (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5),
+    (7, 0, 4, 6, 9, 1, 3, 2, 5, 8)
+)
+
+STATE_CODES = {
+    "AN", "AP", "AR", "AS", "BR", "CG", "CH", "DD", "DL", "DN", "GA", "GJ", "HP", "HR", "JH", "JK", "KA", "KL",
+    "LA", "LD", "MH", "ML", "MN", "MP", "MZ", "NL", "OD", "OR", "PB", "PY", "RJ", "SK", "TG", "TN", "TR", "TS",
+    "UA", "UK", "UP", "WB"
+}
+
+AADHAAR_PATTERN = re.compile(r"[2-9]\d{11}")
+MASKED_AADHAAR_PATTERN = re.compile(r"[X*]{8}\d{4}")
+PAN_PATTERN = re.compile(r"[A-Z]{3}[ABCFGHJLPT][A-Z]\d{4}[A-Z]")
+PASSPORT_PATTERN = re.compile(r"[A-Z][1-9]\d{6}")
+DRIVING_LICENSE_PATTERN = re.compile(r"([A-Z]{2})(\d{2})((?:19|20)\d{2})(\d{7})")
+EPIC_PATTERN = re.compile(r"[A-Z]{3}\d{7}")
+OLD_EPIC_PATTERN = re.compile(r"[A-Z]{2}/\d{2}/\d{3}/\d{6}")
+
+def verhoeff_valid(digits):
+    """True when the last digit of the string is the Verhoeff check digit of the others"""
+    check = 0
+    for position, digit in enumerate(reversed(digits)):
+        check = VERHOEFF_MULTIPLICATION[check][VERHOEFF_PERMUTATION[position % 8][int(digit)]]
+    return check == 0
+
+def _compact(number):
+    return re.sub(r"[\s\-]", "", str(number).upper())
+
+def validate_aadhaar(number):
+    compact = _compact(number)
+    if MASKED_AADHAAR_PATTERN.fullmatch(compact):
+        return True, None
+    if re.fullmatch(r"\d{4}", compact):
+        return None, None
+    if not AADHAAR_PATTERN.fullmatch(compact):
+        return False, "Aadhaar number must be 12 digits not starting with 0 or 1"
+    if not verhoeff_valid(compact):
+        return False, "Aadhaar number fails its checksum"
+    return True, None
+
+def validate_pan(number):
+    if not PAN_PATTERN.fullmatch(_compact(number)):
+        return False, "PAN must be 5 letters, 4 digits and a letter"
+    return True, None
+
+def validate_passport(number):
+    if not PASSPORT_PATTERN.fullmatch(_compact(number)):
+        return False, "Passport number must be a letter followed by 7 digits"
+    return True, None
+
+def validate_driving_license(number):
+    compact = re.sub(r"[\s\-/.]", "", str(number).upper())
+    match = DRIVING_LICENSE_PATTERN.fullmatch(compact)
+    if match and match.group(1) in STATE_CODES:
+        return True, None
+    if compact[:2] not in STATE_CODES or len(re.sub(r"\D", "", compact)) >= 8:
+        return None, None
+    return False, "Driving licence number must be a state code, RTO code, year of issue and 7 digits"
+
+def validate_voter_id(number):
+    compact = _compact(number)
+    if EPIC_PATTERN.fullmatch(compact) or OLD_EPIC_PATTERN.fullmatch(re.sub(r"\s", "", str(number).upper())):
+        return True, None
+    return False, "Voter ID (EPIC) number must be 3 letters followed by 7 digits"
+
+VALIDATORS = {
+    "aadhaar": validate_aadhaar,
+    "pan": validate_pan,
+    "passport": validate_passport,
+    "driving_license": validate_driving_license,
+    "voter_id": validate_voter_id
+}
+
+def validate_document_number(kind, number):
+    """
+    Check a document number against the format of its kind (see verification_rules.document_kind).
+
+    Returns (True, None) for a well formed number, (False, reason) for a malformed one and (None, None)
+    when it can't be told offline, like an unknown kind, a driving licence state code missing from
+    STATE_CODES or an older driving licence format.
+    """
+    validator = VALIDATORS.get(kind)
+    if validator is None or not number:
+        return None, None
+    return validator(number)
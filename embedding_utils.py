@@ -0,0 +1,137 @@
+"""Utility functions to store the face embeddings extracted from the ID's next to their user_pictures record, and to cache the encodings of the reference pictures."""
+import base64
+import hashlib
+import numpy as np
+import os
+import threading
+from collections import OrderedDict
+
+EMBEDDING_DTYPE = np.float16
+EMBEDDING_SIZE = 128
+REFERENCE_CACHE_SIZE = int(os.getenv("REFERENCE_EMBEDDING_CACHE_SIZE", "256"))
+REFERENCE_CACHE_DIR = os.getenv("REFERENCE_EMBEDDING_CACHE_DIR")
+
+def serialize_embedding(embedding):
+    """Pack a 128-d face embedding into a base64 float16 string (~344 characters) for the face_embedding column"""
+    packed = np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+    return base64.b64encode(packed).decode("ascii")
+
+def deserialize_embedding(value):
+    """Unpack a stored face embedding, returns None if the row has no usable embedding"""
+    if not value:
+        return None
+    try:
+        embedding = np.frombuffer(base64.b64decode(value), dtype=EMBEDDING_DTYPE)
+    except (ValueError, TypeError) as e:
+        print(f"Debug: Could not decode stored face embedding: {e}")
+        return None
+    if embedding.shape != (EMBEDDING_SIZE,):
+        return None
+    return embedding.astype(np.float64)
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+class ReferenceEmbeddingCache:
+    """
+    Face encodings of reference pictures, keyed by their storage file_path and by the SHA-256 of their content.
+
+    An in-process LRU of max_entries encodings, optionally backed by cache_dir so encodings survive
+    restarts. Storage paths are unique per upload, so a cached path is returned without downloading
+    the picture again, and the content hash lets a photo uploaded again under a new path reuse its
+    encoding. A picture without a face is cached as None.
+    """
+
+    def __init__(self, max_entries=REFERENCE_CACHE_SIZE, cache_dir=REFERENCE_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._paths = {}
+        self._encodings = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(os.path.join(cache_dir, "paths"), exist_ok=True)
+
+    def get(self, file_path):
+        """Return (found, encoding) for a stored picture without downloading it"""
+        with self._lock:
+            digest = self._paths.get(file_path)
+        if digest is None and self.cache_dir:
+            digest = self._read_disk(self._path_file(file_path))
+        return self._lookup(file_path, digest)
+
+    def get_content(self, file_path, content):
+        """Return (found, encoding) for downloaded picture bytes, recording file_path on a hit"""
+        return self._lookup(file_path, content_hash(content))
+
+    def put(self, file_path, content, encoding):
+        digest = content_hash(content)
+        with self._lock:
+            self._store(file_path, digest, encoding)
+        if self.cache_dir:
+            self._write_disk(self._path_file(file_path), digest)
+            self._write_disk(self._encoding_file(digest), "" if encoding is None else serialize_embedding(encoding))
+
+    def invalidate(self, file_path):
+        """Forget the picture at file_path, called when it is deleted"""
+        with self._lock:
+            digest = self._paths.pop(file_path, None)
+            if digest is not None:
+                self._encodings.pop(digest, None)
+        if self.cache_dir:
+            digest = digest or self._read_disk(self._path_file(file_path))
+            for path in (self._path_file(file_path), digest and self._encoding_file(digest)):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def _lookup(self, file_path, digest):
+        if digest is not None:
+            with self._lock:
+                if digest in self._encodings:
+                    self._encodings.move_to_end(digest)
+                    self._paths[file_path] = digest
+                    self.hits += 1
+                    return True, self._encodings[digest]
+            if self.cache_dir:
+                stored = self._read_disk(self._encoding_file(digest))
+                if stored is not None:
+                    encoding = deserialize_embedding(stored)
+                    with self._lock:
+                        self._store(file_path, digest, encoding)
+                        self.hits += 1
+                    return True, encoding
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def _store(self, file_path, digest, encoding):
+        self._paths[file_path] = digest
+        self._encodings[digest] = encoding
+        self._encodings.move_to_end(digest)
+        while len(self._encodings) > self.max_entries:
+            evicted, _ = self._encodings.popitem(last=False)
+            for path in [path for path, path_digest in self._paths.items() if path_digest == evicted]:
+                del self._paths[path]
+
+    def _path_file(self, file_path):
+        return os.path.join(self.cache_dir, "paths", hashlib.sha256(file_path.encode("utf-8")).hexdigest())
+
+    def _encoding_file(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.emb")
+
+    def _read_disk(self, path):
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, path, value):
+        try:
+            with open(path, "w") as f:
+                f.write(value)
+        except OSError as e:
+            print(f"Debug: Could not write reference embedding cache file {path}: {e}")
+
+reference_embeddings = ReferenceEmbeddingCache()
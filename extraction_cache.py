@@ -0,0 +1,127 @@
+"""Cache of the details extracted from document images, so re-verifying unchanged documents doesn't call the model again."""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from image_utils import read_image_bytes
+
+EXTRACTION_CACHE_SIZE = int(os.getenv("EXTRACTION_CACHE_SIZE", "256"))
+EXTRACTION_CACHE_TTL = float(os.getenv("EXTRACTION_CACHE_TTL", str(7 * 24 * 3600)))
+EXTRACTION_CACHE_DB = os.getenv("EXTRACTION_CACHE_DB")
+EXTRACTION_CACHE_DB_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_DB_MAX_ENTRIES", "10000"))
+
+def image_digest(image_source):
+    """SHA-256 of an image: of the encoded bytes for files and buffers, of the pixels for decoded images"""
+    digest = hashlib.sha256()
+    if isinstance(image_source, Image.Image):
+        image_source = np.asarray(image_source)
+    if isinstance(image_source, np.ndarray):
+        digest.update(str(image_source.shape).encode("ascii"))
+        digest.update(np.ascontiguousarray(image_source).tobytes())
+    else:
+        digest.update(read_image_bytes(image_source))
+    return digest.hexdigest()
+
+class ExtractionCache:
+    """
+    Extraction results keyed by image digest and extraction version (model and prompt).
+
+    An in-memory LRU of max_entries results in front of an optional SQLite file at db_path.
+    Entries older than ttl seconds are treated as missing and dropped, the SQLite tier keeps
+    at most db_max_entries rows, removing the oldest first.
+    """
+
+    def __init__(self, max_entries=EXTRACTION_CACHE_SIZE, ttl=EXTRACTION_CACHE_TTL, db_path=EXTRACTION_CACHE_DB, db_max_entries=EXTRACTION_CACHE_DB_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if db_path:
+            with self._connect() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS extraction_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def get(self, key):
+        """Return a copy of the cached result for key, None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(value)
+                del self._entries[key]
+
+        if self.db_path:
+            try:
+                with self._connect() as db:
+                    row = db.execute("SELECT value, created FROM extraction_cache WHERE key = ?", (key,)).fetchone()
+                    if row is not None and now - row[1] > self.ttl:
+                        db.execute("DELETE FROM extraction_cache WHERE key = ?", (key,))
+                        row = None
+            except sqlite3.Error as e:
+                print(f"Debug: Extraction cache read failed: {e}")
+                row = None
+            if row is not None:
+                with self._lock:
+                    self._store(key, row[0], row[1])
+                    self.hits += 1
+                return json.loads(row[0])
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        value = json.dumps(result)
+        created = time.time()
+        with self._lock:
+            self._store(key, value, created)
+
+        if self.db_path:
+            try:
+                with self._connect() as db:
+                    db.execute("INSERT OR REPLACE INTO extraction_cache (key, value, created) VALUES (?, ?, ?)", (key, value, created))
+                    db.execute("DELETE FROM extraction_cache WHERE created < ?", (created - self.ttl,))
+                    db.execute(
+                        "DELETE FROM extraction_cache WHERE key NOT IN (SELECT key FROM extraction_cache ORDER BY created DESC LIMIT ?)",
+                        (self.db_max_entries,)
+                    )
+            except sqlite3.Error as e:
+                print(f"Debug: Extraction cache write failed: {e}")
+
+    def _store(self, key, value, created):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+extraction_cache = ExtractionCache()
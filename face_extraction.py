@@ -1,70 +1,427 @@
 """Extracts face from ID card, saves it if both haar and face_recognition identify the face"""
 import numpy as np
 import cv2
+import os
+import threading
+import multiprocessing
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from functools import partial
 import face_recognition as fr
+from image_utils import decode_image, exif_orientation, read_image_bytes, iter_document_images
 
-def faceextractor(img_path):
-    
-    face_classifier = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    image = cv2.imread(img_path)
-    if image is None:
-        print("Error: Image not found")
-        return []
+_LOCAL_CASCADE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'haarcascade_frontalface_default.xml')
+_thread_local = threading.local()
+_registry_lock = threading.Lock()
+_cascade_path = None
+_models_warm = False
+_warmup_thread = None
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    all_faces = []
-    rotations = [
-        (None, None), 
-        (cv2.ROTATE_180, cv2.ROTATE_180),
-        (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_CLOCKWISE),
-        (cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE)
-    ]
-
-    for rot_gray, rot_color in rotations:
-        current_gray = gray if rot_gray is None else cv2.rotate(gray, rot_gray)
-        current_image = image if rot_color is None else cv2.rotate(image, rot_color)
-
-        faces = face_classifier.detectMultiScale(
-            current_gray, 
-            scaleFactor=1.3,
-            minNeighbors=5,
-            minSize=(30, 30)
-        )
+def _resolve_cascade_path():
+    """Prefer the cascade shipped with the repo, fall back to the one bundled with OpenCV"""
+    global _cascade_path
+    if _cascade_path is None:
+        with _registry_lock:
+            if _cascade_path is None:
+                if os.path.exists(_LOCAL_CASCADE_PATH):
+                    _cascade_path = _LOCAL_CASCADE_PATH
+                else:
+                    _cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+    return _cascade_path
+
+def get_face_classifier():
+    """Return this thread's face classifier, CascadeClassifier is not thread-safe so each thread loads its own once"""
+    classifier = getattr(_thread_local, 'face_classifier', None)
+    if classifier is None:
+        classifier = cv2.CascadeClassifier(_resolve_cascade_path())
+        if classifier.empty():
+            raise RuntimeError(f"Could not load Haar cascade from {_resolve_cascade_path()}")
+        _thread_local.face_classifier = classifier
+    return classifier
+
+def get_eye_classifier():
+    """Return this thread's eye classifier used to rank face crops, None if OpenCV doesn't ship the eye cascade"""
+    if not hasattr(_thread_local, 'eye_classifier'):
+        classifier = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+        _thread_local.eye_classifier = None if classifier.empty() else classifier
+    return _thread_local.eye_classifier
+
+def warm_up_models():
+    """Load the cascade and run the dlib detector, landmark and encoder models once on a blank image"""
+    global _models_warm
+    if _models_warm:
+        return
+    blank = np.zeros((150, 150, 3), dtype=np.uint8)
+    get_face_classifier().detectMultiScale(cv2.cvtColor(blank, cv2.COLOR_BGR2GRAY))
+    get_eye_classifier()
+    fr.face_locations(blank)
+    fr.face_encodings(blank, known_face_locations=[(25, 125, 125, 25)])
+    _models_warm = True
+
+def start_background_warm_up():
+    """
+    Warm the models on a daemon thread so the first extraction isn't slower than later ones, safe to call on every rerun.
+    The batch extraction process pool is started from the same thread, so its workers are spawned and warm before the first batch.
+    """
+    global _warmup_thread
+    if os.getenv("FACE_MODEL_WARMUP", "1") == "0":
+        return None
+    with _registry_lock:
+        if _models_warm or _warmup_thread is not None:
+            return _warmup_thread
+
+        def _run():
+            try:
+                warm_up_models()
+                pool = _get_process_pool()
+                for future in [pool.submit(warm_up_models) for _ in range(BATCH_WORKERS)]:
+                    future.result()
+            except Exception as e:
+                print(f"Debug: Face model warm-up failed: {e}")
+
+        _warmup_thread = threading.Thread(target=_run, name="face-model-warmup", daemon=True)
+        _warmup_thread.start()
+    return _warmup_thread
+
+ROTATIONS = [
+    None,
+    cv2.ROTATE_180,
+    cv2.ROTATE_90_CLOCKWISE,
+    cv2.ROTATE_90_COUNTERCLOCKWISE
+]
+ROTATION_STRATEGIES = ("all", "first-hit", "parallel")
+DEFAULT_ROTATION_STRATEGY = os.getenv("FACE_ROTATION_STRATEGY", "first-hit")
+DETECTION_MAX_SIDE = int(os.getenv("FACE_DETECTION_MAX_SIDE", "1024"))
+MAX_IMAGE_PIXELS = int(os.getenv("FACE_MAX_IMAGE_PIXELS", "16000000"))
+MAX_CONCURRENT_EXTRACTIONS = int(os.getenv("FACE_MAX_CONCURRENT_EXTRACTIONS", "2"))
+PROFILE_MEMORY = os.getenv("FACE_MEMORY_PROFILE", "0") == "1"
+MAX_ENCODED_FACES = int(os.getenv("FACE_MAX_ENCODED_FACES", "2"))
+NMS_IOU_THRESHOLD = 0.3
+SIDEWAYS_TEXT_MARGIN = 1.3
+SIDEWAYS_ROTATIONS = [
+    cv2.ROTATE_90_CLOCKWISE,
+    cv2.ROTATE_90_COUNTERCLOCKWISE,
+    None,
+    cv2.ROTATE_180
+]
+QUALITY_THUMB_WIDTH = 128
+_extraction_slots = threading.BoundedSemaphore(MAX_CONCURRENT_EXTRACTIONS)
+_profile_lock = threading.Lock()
+BATCH_WORKERS = int(os.getenv("FACE_BATCH_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+_rotation_pool = None
+_process_pool = None
+
+def _get_rotation_pool():
+    """Shared pool for the parallel strategy, kept alive so its threads reuse their cached classifiers"""
+    global _rotation_pool
+    if _rotation_pool is None:
+        with _registry_lock:
+            if _rotation_pool is None:
+                _rotation_pool = ThreadPoolExecutor(max_workers=len(ROTATIONS), thread_name_prefix="face-rotation")
+    return _rotation_pool
+
+def _get_process_pool():
+    """Shared process pool for batch extraction, workers are spawned once and warm their models on start-up"""
+    global _process_pool
+    with _registry_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_up_models
+            )
+        return _process_pool
+
+def _reset_process_pool(broken_pool):
+    """Drop a pool whose worker died so the next batch starts a fresh one, unless another thread already replaced it"""
+    global _process_pool
+    with _registry_lock:
+        if _process_pool is broken_pool:
+            _process_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+def _detection_proxy(image):
+    """Downscale the image so its longest side is at most DETECTION_MAX_SIDE, returns the gray proxy and its scale"""
+    height, width = image.shape[:2]
+    scale = min(1.0, DETECTION_MAX_SIDE / float(max(height, width)))
+    if scale < 1.0:
+        small = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    else:
+        small = image
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), scale
 
-        if len(faces) > 0:
-            for (x, y, w, h) in faces:
-                all_faces.append({
-                    'coords': (x, y, w, h),
-                    'image': current_image,
-                    'rotation': rot_gray
-                })
+def _profile_spikiness(profile):
+    mean = profile.mean()
+    return profile.var() / (mean * mean) if mean > 0 else 0.0
 
-    output_faces = []
+def _text_looks_sideways(proxy_gray):
+    """
+    Cheap text-line orientation check for photos without EXIF orientation.
+
+    Lines of text on an upright card alternate with blank gaps down the page, so the
+    row projection of the ink is much spikier than the column projection. When the
+    columns are spikier the card is most likely lying on its side.
+    """
+    ink = cv2.adaptiveThreshold(proxy_gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    rows = ink.sum(axis=1, dtype=np.float64)
+    columns = ink.sum(axis=0, dtype=np.float64)
+    return _profile_spikiness(columns) > _profile_spikiness(rows) * SIDEWAYS_TEXT_MARGIN
+
+def _rotation_order(has_exif_orientation, proxy_gray):
+    """
+    Order the rotations so the likely upright one is tried first.
+
+    OpenCV already applies the EXIF orientation while decoding, so a tagged photo is
+    upright as decoded. Otherwise the text-line check decides whether the sideways
+    rotations go first. The other rotations stay in the list as the fallback.
+    """
+    if not has_exif_orientation and _text_looks_sideways(proxy_gray):
+        return SIDEWAYS_ROTATIONS
+    return ROTATIONS
+
+def _rotated_box_to_original(box, rotation, height, width):
+    """Map an (x0, y0, x1, y1) box in the rotated frame back onto the original height x width image"""
+    x0, y0, x1, y1 = box
+    if rotation is None:
+        return box
+    if rotation == cv2.ROTATE_180:
+        return (width - x1, height - y1, width - x0, height - y0)
+    if rotation == cv2.ROTATE_90_CLOCKWISE:
+        return (y0, height - x1, y1, height - x0)
+    return (width - y1, x0, width - y0, x1)
+
+def _detect_in_rotation(image, proxy_gray, scale, rotation):
+    """
+    Run Haar detection on the rotated proxy and cut the padded full resolution crop of every hit.
+
+    Only the proxy is rotated, crops are cut straight from the original image and rotated on their
+    own, so no full resolution rotated copy is ever allocated.
+    """
+    height, width = image.shape[:2]
+    if rotation in (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE):
+        rotated_height, rotated_width = width, height
+    else:
+        rotated_height, rotated_width = height, width
+
+    current_gray = proxy_gray if rotation is None else cv2.rotate(proxy_gray, rotation)
+
+    min_side = max(24, int(round(30 * scale)))
+    detections = get_face_classifier().detectMultiScale(
+        current_gray, 
+        scaleFactor=1.3,
+        minNeighbors=5,
+        minSize=(min_side, min_side)
+    )
+    del current_gray
+
+    candidates = []
     
-    for face_info in all_faces:
-        x, y, w, h = face_info['coords']
-        current_image = face_info['image']
-        
+    for box in detections:
+        x, y, w, h = (int(round(v / scale)) for v in box)
         x_pad = max(0, x - 25)
         y_pad = max(0, y - 40)
-        w_pad = w + 50
-        h_pad = h + 70
-        
-        face = current_image[y_pad:y_pad+h_pad, x_pad:x_pad+w_pad]
+        padded = (x_pad, y_pad, min(rotated_width, x_pad + w + 50), min(rotated_height, y_pad + h + 70))
+
+        left, top, right, bottom = _rotated_box_to_original(padded, rotation, height, width)
+        face = image[top:bottom, left:right]
         
         if face.size == 0:
             continue
-            
+        face = face.copy() if rotation is None else cv2.rotate(face, rotation)
+
+        box_left, box_top, box_right, box_bottom = _rotated_box_to_original(
+            (x, y, min(rotated_width, x + w), min(rotated_height, y + h)), rotation, height, width
+        )
+        coords = (box_left, box_top, box_right - box_left, box_bottom - box_top)
+        candidates.append({
+            'face': face,
+            'coords': coords,
+            'rotation': rotation,
+            'score': _quality_score(face, coords)
+        })
+
+    return candidates
+
+def _quality_score(face, coords):
+    """
+    Cheap ranking score for a face crop, the sum of three terms in [0, 1]:
+    face size, Laplacian sharpness of a fixed-width thumbnail and the number of eyes found (up to 2).
+    """
+    size_score = min(np.sqrt(coords[2] * coords[3]) / 300.0, 1.0)
+
+    gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+    thumb_height = max(1, int(gray.shape[0] * QUALITY_THUMB_WIDTH / float(gray.shape[1])))
+    thumb = cv2.resize(gray, (QUALITY_THUMB_WIDTH, thumb_height), interpolation=cv2.INTER_AREA)
+    sharpness_score = min(cv2.Laplacian(thumb, cv2.CV_64F).var() / 500.0, 1.0)
+
+    eye_score = 0.0
+    eye_classifier = get_eye_classifier()
+    if eye_classifier is not None:
+        eyes = eye_classifier.detectMultiScale(thumb[:thumb_height // 2 + 1], scaleFactor=1.1, minNeighbors=5, minSize=(8, 8))
+        eye_score = min(len(eyes), 2) / 2.0
+
+    return size_score + sharpness_score + eye_score
+
+def _box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    overlap_w = min(ax + aw, bx + bw) - max(ax, bx)
+    overlap_h = min(ay + ah, by + bh) - max(ay, by)
+    if overlap_w <= 0 or overlap_h <= 0:
+        return 0.0
+    overlap = overlap_w * overlap_h
+    return overlap / float(aw * ah + bw * bh - overlap)
+
+def _suppress_duplicates(candidates):
+    """Non-max suppression in original image coordinates, keeps the best scored box of every face found across rotations"""
+    kept = []
+    for candidate in sorted(candidates, key=lambda c: c['score'], reverse=True):
+        if all(_box_iou(candidate['coords'], other['coords']) < NMS_IOU_THRESHOLD for other in kept):
+            kept.append(candidate)
+    return kept
+
+def _confirm_face(candidate):
+    """Encode the mirrored crop with face_recognition, returns the output face dict or None if dlib finds no face in it"""
+    face = candidate['face']
+    try:
+        # Mirrored like live_verification_page.load_and_encode, so stored and downloaded references share one pipeline
+        rgb_face = cv2.cvtColor(cv2.flip(face, 1), cv2.COLOR_BGR2RGB)
+        
+        encodings = fr.face_encodings(rgb_face)
+        if len(encodings) > 0:
+            success, encoded_image = cv2.imencode('.jpg', face)
+            if success:
+                return {
+                    'image': encoded_image.tobytes(),
+                    'embedding': encodings[0].astype(np.float32),
+                    'coords': candidate['coords'],
+                    'rotation': candidate['rotation'],
+                    'score': candidate['score']
+                }
+    except Exception as e:
+        print(f"Debug: Face encoding failed: {e}")
+    return None
+
+def _encode_best(candidates, top_k, pool=None):
+    """
+    Encode the best deduplicated candidates until top_k faces are confirmed. A box dlib rejects
+    doesn't suppress anything, the candidates it overlapped get their turn in the next round.
+    """
+    remaining = list(candidates)
+    faces = []
+    while remaining and len(faces) < top_k:
+        ranked = _suppress_duplicates(remaining)[:top_k - len(faces)]
+        if pool is not None and len(ranked) > 1:
+            confirmed = list(pool.map(_confirm_face, ranked))
+        else:
+            confirmed = [_confirm_face(candidate) for candidate in ranked]
+        faces.extend(face for face in confirmed if face is not None)
+        remaining = [
+            candidate for candidate in remaining
+            if not any(candidate is tried for tried in ranked)
+            and all(_box_iou(candidate['coords'], face['coords']) < NMS_IOU_THRESHOLD for face in faces)
+        ]
+    return sorted(faces, key=lambda face: face['score'], reverse=True)
+
+def _measure_peak_memory(extract, *args):
+    """Run one extraction with tracemalloc on and log its peak traced allocation, used when FACE_MEMORY_PROFILE=1"""
+    with _profile_lock:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
         try:
-            rgb_face = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
-            
-            encodings = fr.face_encodings(rgb_face)
-            if len(encodings) > 0:
-                success, encoded_image = cv2.imencode('.jpg', face)
-                if success:
-                    output_faces.append(encoded_image.tobytes())
-        except Exception as e:
-            continue
-    
-    return output_faces
+            return extract(*args)
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+            print(f"Debug: faceextractor peak traced memory {peak / (1024 * 1024):.1f} MiB")
+
+def faceextractor(image_source, rotation_strategy=None, top_k=None):
+    """
+    Return the faces found on the document, best first, as dicts with the JPEG crop ('image'), the
+    float32 face_recognition 'embedding', the box in original image 'coords', the 'rotation' and 'score'.
+
+    image_source is a file path, bytes, a buffer or an image from image_utils.decode_image.
+    rotation_strategy is "all", "first-hit" or "parallel" (default DEFAULT_ROTATION_STRATEGY), top_k
+    the number of faces to encode (default MAX_ENCODED_FACES).
+    """
+    strategy = rotation_strategy or DEFAULT_ROTATION_STRATEGY
+    if strategy not in ROTATION_STRATEGIES:
+        raise ValueError(f"Unknown rotation strategy: {strategy}")
+    top_k = top_k or MAX_ENCODED_FACES
+
+    with _extraction_slots:
+        if PROFILE_MEMORY:
+            return _measure_peak_memory(_extract_faces, image_source, strategy, top_k)
+        return _extract_faces(image_source, strategy, top_k)
+
+def _extract_faces(image_source, strategy, top_k):
+    try:
+        data = image_source if isinstance(image_source, np.ndarray) else read_image_bytes(image_source)
+        image = decode_image(data, max_pixels=MAX_IMAGE_PIXELS)
+    except OSError:
+        image = None
+    if image is None:
+        print("Error: Image not found")
+        return []
+
+    proxy_gray, scale = _detection_proxy(image)
+
+    if strategy == "first-hit":
+        for rotation in _rotation_order(exif_orientation(data) is not None, proxy_gray):
+            confirmed_faces = _encode_best(_detect_in_rotation(image, proxy_gray, scale, rotation), top_k)
+            if confirmed_faces:
+                return confirmed_faces
+        return []
+
+    pool = None
+    if strategy == "parallel":
+        pool = _get_rotation_pool()
+        results = list(pool.map(partial(_detect_in_rotation, image, proxy_gray, scale), ROTATIONS))
+    else:
+        results = [_detect_in_rotation(image, proxy_gray, scale, rotation) for rotation in ROTATIONS]
+
+    del image, proxy_gray
+    candidates = [candidate for faces in results for candidate in faces]
+    return _encode_best(candidates, top_k, pool)
+
+def extract_document_faces(document_source, rotation_strategy=None, top_k=None):
+    """Extract the faces from every page of a document (a photo or a PDF), best first"""
+    faces = []
+    for page in iter_document_images(document_source):
+        faces.extend(faceextractor(page, rotation_strategy, top_k))
+    faces.sort(key=lambda face: face['score'], reverse=True)
+    return faces
+
+def submit_document_faces(document, rotation_strategy=None, top_k=None):
+    """Start extracting the faces of one document on the process pool, returns the job to pass to collect_document_faces"""
+    pool = _get_process_pool()
+    return pool, pool.submit(extract_document_faces, document, rotation_strategy, top_k)
+
+def collect_document_faces(job):
+    """Wait for a submitted extraction, returns {'faces': [...], 'error': None} or an empty face list and the error message"""
+    pool, future = job
+    try:
+        return {'faces': future.result(), 'error': None}
+    except BrokenProcessPool as e:
+        _reset_process_pool(pool)
+        return {'faces': [], 'error': f"Face extraction worker stopped: {e}"}
+    except Exception as e:
+        return {'faces': [], 'error': str(e)}
+
+def extract_faces_batch(documents, rotation_strategy=None, top_k=None):
+    """
+    Extract the faces of several documents at once on a bounded process pool, so dlib encoding uses all cores.
+
+    Returns one {'faces': [...], 'error': None} dict per document in the same order as documents.
+    A document that fails gets an empty face list and the error message instead of failing the batch.
+    """
+    if not documents:
+        return []
+
+    jobs = [submit_document_faces(document, rotation_strategy, top_k) for document in documents]
+    return [collect_document_faces(job) for job in jobs]
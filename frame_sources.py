@@ -0,0 +1,189 @@
+"""Frame sources for live verification (webcam, recorded video, image sequence) and the capture helpers that feed the newest frame to inference."""
+import cv2
+import glob
+import os
+import queue
+import threading
+import time
+
+class WebcamSource:
+    """Frames from a local camera, always paced by the camera itself"""
+
+    realtime = True
+
+    def __init__(self, index=0):
+        self.capture = cv2.VideoCapture(index)
+
+    def is_opened(self):
+        return self.capture.isOpened()
+
+    def read(self):
+        return self.capture.read()
+
+    def release(self):
+        self.capture.release()
+
+class VideoFileSource:
+    """
+    Frames from a recorded session, used to replay and benchmark live verification.
+
+    By default every frame is returned as fast as it can be processed and the session clock follows
+    the video's own timestamps, so a replay gives the same result on every run. With realtime=True
+    reads are paced to the video's frame rate and the session behaves like a live camera.
+    """
+
+    def __init__(self, path, realtime=False, fps=None):
+        self.capture = cv2.VideoCapture(path)
+        self.realtime = realtime
+        self.fps = fps or self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frames_read = 0
+        self._started = None
+
+    def is_opened(self):
+        return self.capture.isOpened()
+
+    def read(self):
+        if self.realtime:
+            _wait_for_frame(self)
+        ret, frame = self.capture.read()
+        if ret:
+            self.frames_read += 1
+        return ret, frame
+
+    def position(self):
+        """Seconds of the recording consumed so far"""
+        return self.frames_read / self.fps
+
+    def release(self):
+        self.capture.release()
+
+class ImageSequenceSource:
+    """Frames from a directory (read in name order) or a list of image files, played back at fps"""
+
+    def __init__(self, images, fps=15.0, realtime=False):
+        if isinstance(images, str):
+            images = sorted(
+                path for path in glob.glob(os.path.join(images, "*"))
+                if os.path.splitext(path)[1].lower() in (".jpg", ".jpeg", ".png", ".bmp")
+            )
+        self.paths = list(images)
+        self.fps = fps
+        self.realtime = realtime
+        self.frames_read = 0
+        self._started = None
+
+    def is_opened(self):
+        return bool(self.paths)
+
+    def read(self):
+        if self.frames_read >= len(self.paths):
+            return False, None
+        if self.realtime:
+            _wait_for_frame(self)
+        frame = cv2.imread(self.paths[self.frames_read])
+        self.frames_read += 1
+        return frame is not None, frame
+
+    def position(self):
+        return self.frames_read / self.fps
+
+    def release(self):
+        self.paths = []
+
+def _wait_for_frame(source):
+    """Sleep until the next frame of a recorded source is due in real time"""
+    now = time.monotonic()
+    if source._started is None:
+        source._started = now
+        return
+    delay = source._started + source.frames_read / source.fps - now
+    if delay > 0:
+        time.sleep(delay)
+
+def open_frame_source(spec=None, realtime=False):
+    """
+    Open the frame source described by spec: a camera index (default 0), a video file or a directory of frames.
+    The LIVE_FRAME_SOURCE environment variable is used when spec is not given.
+    """
+    spec = spec if spec is not None else os.getenv("LIVE_FRAME_SOURCE", "0")
+    if isinstance(spec, int) or str(spec).isdigit():
+        return WebcamSource(int(spec))
+    if os.path.isdir(spec):
+        return ImageSequenceSource(spec, realtime=realtime)
+    return VideoFileSource(spec, realtime=realtime)
+
+class LatestFrameReader:
+    """
+    Reads frames from a capture on a background thread and keeps only the newest one.
+
+    The queue holds a single frame, so when inference is slower than the camera the stale
+    frames are dropped here instead of piling up in the camera buffer.
+    """
+
+    def __init__(self, capture, read_timeout=2.0):
+        self.capture = capture
+        self.read_timeout = read_timeout
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self._frames = queue.Queue(maxsize=1)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="live-capture", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.is_set():
+            ret, frame = self.capture.read()
+            if not ret:
+                self._replace((False, None))
+                break
+            self.frames_read += 1
+            self._replace((True, frame))
+
+    def _replace(self, item):
+        try:
+            self._frames.get_nowait()
+            self.frames_dropped += 1
+        except queue.Empty:
+            pass
+        self._frames.put_nowait(item)
+
+    def read(self):
+        """Return (ret, frame) for the newest frame, waiting for the next one if it was already taken"""
+        try:
+            return self._frames.get(timeout=self.read_timeout)
+        except queue.Empty:
+            return False, None
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join(timeout=self.read_timeout)
+
+class InferencePacer:
+    """
+    Adapts how often frames are scored to the measured inference latency.
+
+    Keeps an exponential moving average of the time spent scoring a frame and leaves idle
+    time after each one, so inference takes at most max_duty of the loop. On a fast host
+    every frame gets scored, on a loaded host frames are skipped instead of queued.
+    """
+
+    def __init__(self, max_duty=0.8, smoothing=0.3):
+        self.max_duty = max_duty
+        self.smoothing = smoothing
+        self.latency = None
+        self._next_time = 0.0
+
+    def ready(self):
+        return time.monotonic() >= self._next_time
+
+    def record(self, started, finished):
+        """Record one scored frame, both times from time.monotonic()"""
+        elapsed = finished - started
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = self.smoothing * elapsed + (1 - self.smoothing) * self.latency
+        self._next_time = finished + self.latency * (1.0 / self.max_duty - 1.0)
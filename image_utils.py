@@ -0,0 +1,109 @@
+"""Utility functions to read uploaded document images from memory, so each document is decoded once and never written to disk."""
+import cv2
+import numpy as np
+import os
+from io import BytesIO
+from PIL import Image
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "200"))
+MAX_PDF_PAGES = int(os.getenv("PDF_MAX_PAGES", "4"))
+
+def read_image_bytes(source):
+    """Return the raw bytes of a file path, bytes-like object or file-like buffer"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, 'getvalue'):
+        return source.getvalue()
+    if hasattr(source, 'read'):
+        return source.read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+def image_mime_type(data):
+    """Sniff the mime type of encoded image bytes, None if it isn't a format sent to the model as-is"""
+    if data[:3] == b'\xff\xd8\xff':
+        return "image/jpeg"
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return "image/png"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return "image/webp"
+    return None
+
+def decode_image(source, max_pixels=None):
+    """
+    Decode a document image into a BGR array, None if it can't be decoded.
+
+    Images with more than max_pixels pixels are decoded at 1/2, 1/4 or 1/8 size
+    with the reduced JPEG decoders instead of being decoded in full and resized.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    data = read_image_bytes(source)
+    flags = cv2.IMREAD_COLOR
+    if max_pixels:
+        try:
+            with Image.open(BytesIO(data)) as header:
+                width, height = header.size
+            pixels = width * height
+            if pixels > max_pixels:
+                for factor, reduced_flag in ((2, cv2.IMREAD_REDUCED_COLOR_2), (4, cv2.IMREAD_REDUCED_COLOR_4), (8, cv2.IMREAD_REDUCED_COLOR_8)):
+                    flags = reduced_flag
+                    if pixels <= max_pixels * factor * factor:
+                        break
+        except Exception as e:
+            print(f"Debug: Could not read image header, decoding at full size: {e}")
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+def exif_orientation(source):
+    """Return the EXIF orientation tag of an encoded image, None if it has none (or is already decoded)"""
+    if isinstance(source, np.ndarray):
+        return None
+    try:
+        with Image.open(BytesIO(read_image_bytes(source))) as header:
+            return header.getexif().get(0x0112)
+    except Exception:
+        return None
+
+def to_pil_image(image):
+    """Convert a decoded BGR array into an RGB PIL image"""
+    return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+def is_pdf(data):
+    return bytes(data[:5]) == b'%PDF-'
+
+def iter_pdf_pages(data, dpi=None, max_pages=None):
+    """
+    Render the pages of a PDF one at a time as BGR arrays.
+
+    Pages are rendered lazily, so only the page being processed is held in memory,
+    and at most max_pages (default MAX_PDF_PAGES) pages are rendered.
+    """
+    if fitz is None:
+        raise RuntimeError("PyMuPDF is required to read PDF documents, install it with: pip install pymupdf")
+    zoom = (dpi or PDF_RENDER_DPI) / 72.0
+    max_pages = max_pages or MAX_PDF_PAGES
+    with fitz.open(stream=data, filetype="pdf") as pdf:
+        for page_number in range(min(pdf.page_count, max_pages)):
+            pixmap = pdf.load_page(page_number).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            page = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+            del pixmap
+            if page.shape[2] == 1:
+                yield cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+            else:
+                yield cv2.cvtColor(page, cv2.COLOR_RGB2BGR)
+
+def iter_document_images(source):
+    """Yield the images of an uploaded document, a rendered array per PDF page or the encoded bytes of a photo"""
+    if isinstance(source, np.ndarray):
+        yield source
+        return
+    data = read_image_bytes(source)
+    if is_pdf(data):
+        yield from iter_pdf_pages(data)
+    else:
+        yield data
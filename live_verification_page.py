@@ -1,16 +1,31 @@
-"""Page for performing live verification of individual, done by matching ID and Profile photo 10 times in the span of 30 seconds. Will only pass if 10 matches are recived and mismatches are 2 or lesser."""
+"""Page for performing live verification of individual, done by matching ID and Profile photo 10 times in the span of 30 seconds, every document is scored in the same camera session. Will only pass if 10 matches are recived and mismatches are 2 or lesser."""
 import streamlit as st
 import face_recognition as fr
 import cv2
-import time
-import numpy as np
 from supabase_client import supabase
 from photo_utils import get_user_picture
-import tempfile
+from embedding_utils import deserialize_embedding, reference_embeddings
+from live_verification_utils import DEFAULT_MATCH_POLICY, LivenessCheck, ReferenceSet, PreviewRenderer, run_live_session
+from frame_sources import open_frame_source
+from image_utils import decode_image
+from concurrent.futures import ThreadPoolExecutor
 import os
 
-def load_and_encode(image_path):
-    img = cv2.imread(image_path)
+DECISION_MODES = ("sprt", "fixed")
+DEFAULT_DECISION_MODE = os.getenv("LIVE_DECISION_MODE", "sprt")
+LIVENESS_MODE = os.getenv("LIVE_LIVENESS_MODE", "either")
+SPRT_ALPHA = float(os.getenv("LIVE_SPRT_ALPHA", "0.001"))
+SPRT_BETA = float(os.getenv("LIVE_SPRT_BETA", "0.01"))
+SPRT_MIN_FRAMES = int(os.getenv("LIVE_SPRT_MIN_FRAMES", "3"))
+SPRT_MIN_REJECT_FRAMES = int(os.getenv("LIVE_SPRT_MIN_REJECT_FRAMES", "30"))
+PREVIEW_MAX_FPS = float(os.getenv("LIVE_PREVIEW_MAX_FPS", "10"))
+PREVIEW_MAX_WIDTH = int(os.getenv("LIVE_PREVIEW_MAX_WIDTH", "480"))
+REFERENCE_DOWNLOAD_WORKERS = int(os.getenv("LIVE_REFERENCE_DOWNLOAD_WORKERS", "4"))
+
+def load_and_encode(image):
+    img = decode_image(image)
+    if img is None:
+        return None
     img = cv2.flip(img, 1)
     rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     encodings = fr.face_encodings(rgb)
@@ -18,24 +33,101 @@ def load_and_encode(image_path):
         return None
     return encodings[0]
 
-def download_and_save_image(url, temp_dir):
+def download_reference(url):
+    """
+    Download a reference picture into memory and encode its face, returns (content, encoding, error).
+    The encoding is reused from the reference embedding cache when the same picture was encoded before.
+    Runs on a worker thread, so errors are returned to be shown by the page instead of calling streamlit here.
+    """
     try:
         file_path = url.split('user-pictures/')[-1]
         file_content = supabase.storage.from_("user-pictures").download(file_path)
-
-        temp_file_path = os.path.join(temp_dir, os.path.basename(file_path))
-        with open(temp_file_path, 'wb') as f:
-            f.write(file_content)
-        
-        return temp_file_path
+        found, encoding = reference_embeddings.get_content(file_path, file_content)
+        if not found:
+            encoding = load_and_encode(file_content)
+            reference_embeddings.put(file_path, file_content, encoding)
+        return file_content, encoding, None
     except Exception as e:
-        st.error(f"Error downloading image: {str(e)}")
-        return None
+        return None, None, str(e)
+
+def load_references(pictures):
+    """
+    Return the reference images and face encodings of the user's pictures, keyed by 'profile' or document type.
+
+    Pictures with a stored face embedding or an encoding in the reference embedding cache are shown
+    from their public URL. The others are downloaded concurrently on a bounded thread pool and decoded
+    from memory. The result is kept in the session, so the reruns streamlit triggers on every
+    interaction don't download the pictures again.
+    """
+    cache_key = tuple(sorted(picture['file_path'] for picture in pictures if 'file_path' in picture))
+    cached = st.session_state.get('live_references')
+    if cached and cached['key'] == cache_key:
+        return cached['images'], cached['encodings']
+
+    images = {}
+    encodings = {}
+    downloads = {}
+    for picture in pictures:
+        if 'file_path' in picture:
+            doc_type = picture.get('document_type', 'unknown')
+            key = 'profile' if doc_type.lower() == 'profile' else doc_type
+            stored_encoding = deserialize_embedding(picture.get('face_embedding'))
+            if stored_encoding is not None:
+                encodings[key] = stored_encoding
+                images[key] = supabase.storage.from_("user-pictures").get_public_url(picture['file_path'])
+                continue
+            found, cached_encoding = reference_embeddings.get(picture['file_path'])
+            if found:
+                encodings[key] = cached_encoding
+                images[key] = supabase.storage.from_("user-pictures").get_public_url(picture['file_path'])
+            else:
+                images[key] = None
+                downloads[key] = picture['file_path']
+
+    failed = False
+    if downloads:
+        with ThreadPoolExecutor(max_workers=min(REFERENCE_DOWNLOAD_WORKERS, len(downloads))) as pool:
+            fetched = dict(zip(downloads, pool.map(download_reference, downloads.values())))
+        for key, (content, encoding, error) in fetched.items():
+            if error:
+                st.error(f"Error downloading image: {error}")
+                failed = True
+                continue
+            images[key] = content
+            encodings[key] = encoding
+
+    images = {key: image for key, image in images.items() if image is not None}
+    print(f"Debug: Reference embedding cache hits: {reference_embeddings.hits}, misses: {reference_embeddings.misses}")
+    if not failed:
+        st.session_state.live_references = {'key': cache_key, 'images': images, 'encodings': encodings}
+    return images, encodings
+
+def reference_encoding(image, known_encodings, key):
+    """Use the embedding stored at extraction time or encoded when the page loaded, otherwise encode the image"""
+    if key in known_encodings:
+        return known_encodings[key]
+    return load_and_encode(image)
 
-def perform_live_verification(profile_image_path, other_image_paths):
+def perform_live_verification(profile_image, other_images, known_encodings=None, policy=None, decision_mode=None, frame_source=None, liveness_mode=None,
+                              sprt_alpha=None, sprt_beta=None, sprt_min_frames=None, sprt_min_reject_frames=None):
+    """
+    decision_mode "fixed" needs 10 matching frames per document within 30 seconds. "sprt" decides each
+    document as soon as the sequential test over its distances is confident either way, and falls back
+    to the fixed count for documents still undecided when time runs out.
+    Frames come from frame_source, by default the one configured with LIVE_FRAME_SOURCE (the webcam).
+    liveness_mode "either", "blink" or "head-pose" also requires a blink or head movement in the
+    session before any document passes, "off" only checks identity.
+    """
+    known_encodings = known_encodings or {}
+    policy = policy or DEFAULT_MATCH_POLICY
+    decision_mode = decision_mode or DEFAULT_DECISION_MODE
+    if decision_mode not in DECISION_MODES:
+        raise ValueError(f"Unknown decision mode: {decision_mode}")
+    liveness_mode = liveness_mode or LIVENESS_MODE
+    liveness = None if liveness_mode == "off" else LivenessCheck(liveness_mode)
 
     try:
-        profile_faceenc = load_and_encode(profile_image_path)
+        profile_faceenc = reference_encoding(profile_image, known_encodings, 'profile')
         if profile_faceenc is None:
             st.error("Could not detect face in profile image")
             return False, None
@@ -43,90 +135,60 @@ def perform_live_verification(profile_image_path, other_image_paths):
         st.error(f"Error loading profile image: {e}")
         return False, None
 
-    videocapture = cv2.VideoCapture(0)
-    if not videocapture.isOpened():
-        st.error("Could not open video capture")
-        return False, None
-
-    matches_required = 10
-    successful_matches = 0
-    total_time = 30
-    start_time = time.time()
-    frame_count = 0
-    verification_results = {}
+    reference_errors = {}
+    doc_encodings = {}
 
-    video_placeholder = st.empty()
-
-    for doc_type, image_path in other_image_paths.items():
+    for doc_type, image in other_images.items():
         try:
-            other_faceenc = load_and_encode(image_path)
+            other_faceenc = reference_encoding(image, known_encodings, doc_type)
             if other_faceenc is None:
-                verification_results[doc_type] = "No face detected"
+                reference_errors[doc_type] = "No face detected"
                 continue
 
             ref_match = fr.compare_faces([profile_faceenc], other_faceenc)[0]
             if not ref_match:
-                verification_results[doc_type] = "Reference mismatch"
+                reference_errors[doc_type] = "Reference mismatch"
                 continue
         except Exception as e:
-            verification_results[doc_type] = f"Error: {str(e)}"
+            reference_errors[doc_type] = f"Error: {str(e)}"
             continue
 
-        successful_matches = 0
-        start_time = time.time()
-        
-        while (time.time() - start_time < total_time and 
-               successful_matches < matches_required):
-            ret, frame = videocapture.read()
-            if not ret:
-                break
-
-            try:
-                if frame_count % 3 != 0:
-                    frame_count += 1
-                    continue
-
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                face_locations = fr.face_locations(rgb_frame)
-                
-                if len(face_locations) != 1:
-                    status = "Ensure one face in frame" if len(face_locations) == 0 else "Multiple faces detected"
-                    cv2.putText(frame, status, (50, 50), 
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 255), 2)
-                    video_placeholder.image(frame, channels="BGR")
-                    frame_count += 1
-                    continue
-
-                face_encoding = fr.face_encodings(rgb_frame, face_locations)[0]
-
-                match1 = fr.compare_faces([profile_faceenc], face_encoding)[0]
-                match2 = fr.compare_faces([other_faceenc], face_encoding)[0]
-                dist1 = fr.face_distance([profile_faceenc], face_encoding)[0]
-                dist2 = fr.face_distance([other_faceenc], face_encoding)[0]
-
-                top, right, bottom, left = face_locations[0]
-                color = (0, 255, 0) if ((dist1 <= 0.50 and dist2 <= 0.50) or (dist1 <= 0.60 and dist2 <= 0.45) or (dist1 <= 0.45 and dist2 <= 0.60)) else (0, 0, 255)
-                cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-                
-                status = f"Match {successful_matches+1}/{matches_required}" if ((dist1 <= 0.50 and dist2 <= 0.50) or (dist1 <= 0.60 and dist2 <= 0.45) or (dist1 <= 0.45 and dist2 <= 0.60)) else "No match"
-                cv2.putText(frame, f"{status} {doc_type} D1:{dist1:.2f} D2:{dist2:.2f}", 
-                           (left, top-10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-                
-                video_placeholder.image(frame, channels="BGR")
-                
-                if ((dist1 <= 0.50 and dist2 <= 0.50) or (dist1 <= 0.60 and dist2 <= 0.45) or (dist1 <= 0.45 and dist2 <= 0.60)):
-                    successful_matches += 1
-                
-                frame_count += 1
+        doc_encodings[doc_type] = other_faceenc
 
-            except Exception as e:
-                st.error(f"Error processing frame: {e}")
-                frame_count += 1
+    references = ReferenceSet(profile_faceenc, doc_encodings)
+    session_results = {}
 
-        verification_results[doc_type] = successful_matches >= matches_required
+    if references.doc_types:
+        source = frame_source or open_frame_source(realtime=True)
+        if not source.is_opened():
+            st.error("Could not open video capture")
+            return False, None
 
-    videocapture.release()
-    cv2.destroyAllWindows()
+        try:
+            session = run_live_session(
+                references, source, policy=policy, decision_mode=decision_mode,
+                preview=PreviewRenderer(st.empty(), max_fps=PREVIEW_MAX_FPS, max_width=PREVIEW_MAX_WIDTH),
+                on_error=lambda e: st.error(f"Error processing frame: {e}"),
+                liveness=liveness,
+                sprt_alpha=SPRT_ALPHA if sprt_alpha is None else sprt_alpha,
+                sprt_beta=SPRT_BETA if sprt_beta is None else sprt_beta,
+                sprt_min_frames=SPRT_MIN_FRAMES if sprt_min_frames is None else sprt_min_frames,
+                sprt_min_reject_frames=SPRT_MIN_REJECT_FRAMES if sprt_min_reject_frames is None else sprt_min_reject_frames
+            )
+        finally:
+            source.release()
+            cv2.destroyAllWindows()
+        session_results = session['results']
+        print(f"Debug: Live verification session stats: {session['stats']}")
+
+    verification_results = {}
+    for doc_type in other_images:
+        if doc_type in reference_errors:
+            verification_results[doc_type] = reference_errors[doc_type]
+        else:
+            verification_results[doc_type] = session_results[doc_type]
+            if verification_results[doc_type] == True and session['liveness'] == False:
+                verification_results[doc_type] = "Liveness not confirmed, blink or turn your head slightly"
 
     overall_result = all(result == True for result in verification_results.values())
     return overall_result, verification_results
@@ -145,7 +207,8 @@ def live_verification_page():
     1. Make sure you're in a well-lit area
     2. Position your face in the frame
     3. Ensure you are the only person on screen
-    4. You'll need to match your face 10 times within 30 seconds for each document type
+    4. You'll need to match your face 10 times within 30 seconds, all document types are checked at the same time and clear matches finish early
+    5. Blink or turn your head slightly during the check so it knows it's a live person
     """)
     
     user_id = st.session_state.supabase_session.user.id
@@ -155,73 +218,63 @@ def live_verification_page():
         st.error("At least 2 reference images are required for live verification")
         st.stop()
     
-    with tempfile.TemporaryDirectory() as temp_dir:
-        image_paths = {}
-        profile_image_path = None
-        
-        for picture in pictures:
-            if 'file_path' in picture:
-                image_path = download_and_save_image(picture['file_path'], temp_dir)
-                if image_path:
-                    doc_type = picture.get('document_type', 'unknown')
-                    if doc_type.lower() == 'profile':
-                        profile_image_path = image_path
-                    else:
-                        image_paths[doc_type] = image_path
-        
-        if not profile_image_path:
-            st.error("Profile image not found - required for verification")
-            st.stop()
-        
-        if not image_paths:
-            st.error("No other document images found for verification")
-            st.stop()
-        
-        
-        st.subheader("Reference Images for Verification")
-        cols = st.columns(len(image_paths) + 1)  
-        
+    reference_images, known_encodings = load_references(pictures)
+    reference_images = dict(reference_images)
+    profile_image = reference_images.pop('profile', None)
+
+    if not profile_image:
+        st.error("Profile image not found - required for verification")
+        st.stop()
+    
+    if not reference_images:
+        st.error("No other document images found for verification")
+        st.stop()
+    
+    
+    st.subheader("Reference Images for Verification")
+    cols = st.columns(len(reference_images) + 1)  
+    
+    
+    with cols[0]:
+        st.image(profile_image, caption="Your Profile Photo", width=150)
+    
+    
+    for i, (doc_type, image) in enumerate(reference_images.items(), start=1):
+        with cols[i]:
+            st.image(image, caption=f"{doc_type} Photo", width=150)
+    
+    if st.button("Start Live Verification"):
         
-        with cols[0]:
-            st.image(profile_image_path, caption="Your Profile Photo", width=150)
+        col1, col2 = st.columns([3, 1])
         
+        with col1:
+            st.subheader("Live Verification")
+            with st.spinner("Verifying your identity against all document types..."):
+                verification_result, detailed_results = perform_live_verification(profile_image, reference_images, known_encodings)
+                st.session_state.live_verified = verification_result
+                st.session_state.verification_details = detailed_results
+                
+                if verification_result:
+                    st.success("Live verification successful!")
+                else:
+                    st.error("Live verification failed")
         
-        for i, (doc_type, image_path) in enumerate(image_paths.items(), start=1):
-            with cols[i]:
-                st.image(image_path, caption=f"{doc_type} Photo", width=150)
+        with col2:
+            st.subheader("Reference Images")
+            st.image(profile_image, caption="Profile", width=120)
+            for doc_type, image in reference_images.items():
+                st.image(image, caption=doc_type, width=120)
         
-        if st.button("Start Live Verification"):
-            
-            col1, col2 = st.columns([3, 1])
-            
-            with col1:
-                st.subheader("Live Verification")
-                with st.spinner("Verifying your identity against all document types..."):
-                    verification_result, detailed_results = perform_live_verification(profile_image_path, image_paths)
-                    st.session_state.live_verified = verification_result
-                    st.session_state.verification_details = detailed_results
-                    
-                    if verification_result:
-                        st.success("Live verification successful!")
-                    else:
-                        st.error("Live verification failed")
-            
-            with col2:
-                st.subheader("Reference Images")
-                st.image(profile_image_path, caption="Profile", width=120)
-                for doc_type, image_path in image_paths.items():
-                    st.image(image_path, caption=doc_type, width=120)
-            
-            st.subheader("Verification Details")
-            for doc_type, result in detailed_results.items():
-                if result == True:
-                    st.success(f"✅ {doc_type}: Verified")
-                elif result == "No face detected - skipped":
-                    st.warning(f"⚠️ {doc_type}: No face detected - skipped")
-                elif isinstance(result, str):
-                    st.error(f"❌ {doc_type}: {result}")
-                else:
-                    st.error(f"❌ {doc_type}: Failed")
-    
+        st.subheader("Verification Details")
+        for doc_type, result in detailed_results.items():
+            if result == True:
+                st.success(f"✅ {doc_type}: Verified")
+            elif result == "No face detected - skipped":
+                st.warning(f"⚠️ {doc_type}: No face detected - skipped")
+            elif isinstance(result, str):
+                st.error(f"❌ {doc_type}: {result}")
+            else:
+                st.error(f"❌ {doc_type}: Failed")
+
     if st.session_state.get('live_verified', False):
         st.write("You can now proceed to signature upload")
@@ -0,0 +1,459 @@
+"""Utility functions for scoring the live webcam frames against the profile and document reference faces."""
+import numpy as np
+import cv2
+import time
+from collections import deque
+import dlib
+import face_recognition as fr
+from frame_sources import LatestFrameReader, InferencePacer
+
+class MatchPolicy:
+    """
+    Decides whether a frame matches a document.
+
+    A frame matches a document when its distance to the profile photo and its distance to
+    the document photo fall under one of the (profile, document) threshold pairs.
+    """
+
+    def __init__(self, threshold_pairs=((0.50, 0.50), (0.60, 0.45), (0.45, 0.60))):
+        pairs = np.asarray(threshold_pairs, dtype=np.float64).reshape(-1, 2)
+        self.profile_thresholds = pairs[:, 0]
+        self.document_thresholds = pairs[:, 1]
+
+    def matches(self, profile_distance, document_distances):
+        """Decide every document at once, returns a boolean array aligned with document_distances"""
+        profile_ok = profile_distance <= self.profile_thresholds
+        document_ok = np.asarray(document_distances)[:, None] <= self.document_thresholds
+        return (document_ok & profile_ok).any(axis=1)
+
+    def policy_distances(self, profile_distance, document_distances):
+        """Per-document distance relative to the closest threshold pair, at most 1 when the document matches"""
+        profile_ratio = profile_distance / self.profile_thresholds
+        document_ratio = np.asarray(document_distances)[:, None] / self.document_thresholds
+        return np.maximum(profile_ratio, document_ratio).min(axis=1)
+
+DEFAULT_MATCH_POLICY = MatchPolicy()
+
+class SequentialMatchTest:
+    """
+    Wald's sequential probability ratio test over the frames' policy distances, one running test per document.
+
+    alpha is the false accept rate and beta the false reject rate. A document is only accepted on a frame
+    the policy matched and after min_frames frames, and only rejected after min_reject_frames frames.
+    """
+
+    def __init__(self, count, policy=DEFAULT_MATCH_POLICY, alpha=0.001, beta=0.01, match_mean=0.80, non_match_mean=1.20, sigma=0.24, min_frames=3, min_reject_frames=30):
+        self.policy = policy
+        self.match_mean = match_mean
+        self.non_match_mean = non_match_mean
+        self.variance = sigma * sigma
+        self.min_frames = min_frames
+        self.min_reject_frames = min_reject_frames
+        self.accept_bound = np.log((1 - beta) / alpha)
+        self.reject_bound = np.log(beta / (1 - alpha))
+        self.log_ratios = np.zeros(count)
+        self.frames = np.zeros(count, dtype=int)
+        self.decisions = np.zeros(count, dtype=int)
+
+    def update(self, profile_distance, document_distances):
+        """Add one frame to every undecided test, decisions are 1 (accept), -1 (reject) or 0 (undecided)"""
+        distances = self.policy.policy_distances(profile_distance, document_distances)
+        matched = self.policy.matches(profile_distance, document_distances)
+        frame_ratios = ((distances - self.non_match_mean) ** 2 - (distances - self.match_mean) ** 2) / (2 * self.variance)
+        undecided = self.decisions == 0
+        self.log_ratios[undecided] += frame_ratios[undecided]
+        self.frames[undecided] += 1
+        ready = undecided & (self.frames >= self.min_frames)
+        self.decisions[ready & matched & (self.log_ratios >= self.accept_bound)] = 1
+        can_reject = undecided & (self.frames >= self.min_reject_frames)
+        self.decisions[can_reject & (self.log_ratios <= self.reject_bound)] = -1
+        return self.decisions
+
+class ReferenceSet:
+    """The reference embeddings stacked once into a contiguous matrix, row 0 is the profile and the rest follow doc_types"""
+
+    def __init__(self, profile_encoding, document_encodings):
+        self.doc_types = list(document_encodings)
+        rows = [profile_encoding] + [document_encodings[doc_type] for doc_type in self.doc_types]
+        self.matrix = np.ascontiguousarray(np.vstack(rows), dtype=np.float64)
+
+    def distances(self, face_encoding):
+        """Distance from one frame encoding to every reference in a single array operation"""
+        return np.linalg.norm(self.matrix - face_encoding, axis=1)
+
+    def score(self, face_encoding, policy=DEFAULT_MATCH_POLICY):
+        """Return the profile distance, the per-document distances and the per-document match decisions"""
+        distances = self.distances(face_encoding)
+        return distances[0], distances[1:], policy.matches(distances[0], distances[1:])
+
+class FaceLocator:
+    """
+    Finds the face in live frames without running full resolution HOG detection on every frame.
+
+    Detection runs on a copy downscaled to detect_width pixels and the boxes are mapped back to
+    the full frame. While exactly one face is in view its box is followed between detections with
+    Lucas-Kanade optical flow on the small gray frame, and the HOG detector only runs again every
+    redetect_interval frames or as soon as fewer than min_tracked_ratio of the tracked points survive.
+    Locations use face_recognition's (top, right, bottom, left) order in full frame coordinates.
+    last_detected tells whether the last boxes came from the detector rather than the tracker.
+    """
+
+    def __init__(self, detect_width=320, redetect_interval=5, min_tracked_ratio=0.6):
+        self.detect_width = detect_width
+        self.redetect_interval = redetect_interval
+        self.min_tracked_ratio = min_tracked_ratio
+        self.detections = 0
+        self.tracked_frames = 0
+        self.last_detected = False
+        self._reset()
+
+    def _reset(self):
+        self._box = None
+        self._points = None
+        self._previous_gray = None
+        self._frames_since_detection = 0
+
+    def locate(self, frame, detect=False):
+        """Boxes of the faces in frame, detect=True runs the detector even while a face is being tracked"""
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.detect_width / float(width))
+        small = frame if scale == 1.0 else cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        if not detect and self._box is not None and self._frames_since_detection < self.redetect_interval:
+            box = self._track(gray)
+            if box is not None:
+                self.last_detected = False
+                self.tracked_frames += 1
+                self._frames_since_detection += 1
+                return [self._to_frame(box, scale, height, width)]
+
+        self.detections += 1
+        self.last_detected = True
+        locations = fr.face_locations(cv2.cvtColor(small, cv2.COLOR_BGR2RGB))
+        self._reset()
+        if len(locations) == 1:
+            self._start_tracking(gray, locations[0])
+        return [self._to_frame(location, scale, height, width) for location in locations]
+
+    def _start_tracking(self, gray, box):
+        top, right, bottom, left = box
+        mask = np.zeros_like(gray)
+        mask[max(0, top):bottom, max(0, left):right] = 255
+        points = cv2.goodFeaturesToTrack(gray, maxCorners=40, qualityLevel=0.01, minDistance=3, mask=mask)
+        if points is None or len(points) < 8:
+            return
+        self._box = box
+        self._points = points
+        self._previous_gray = gray
+
+    def _track(self, gray):
+        """Move the box by the median flow of its feature points, None when tracking is no longer trustworthy"""
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self._previous_gray, gray, self._points, None)
+        if next_points is None:
+            return None
+        tracked = status.reshape(-1) == 1
+        if tracked.mean() < self.min_tracked_ratio or tracked.sum() < 8:
+            return None
+
+        shift_x, shift_y = np.median(next_points[tracked] - self._points[tracked], axis=0).reshape(2)
+        top, right, bottom, left = self._box
+        dx, dy = int(round(shift_x)), int(round(shift_y))
+        self._box = (top + dy, right + dx, bottom + dy, left + dx)
+        self._points = next_points[tracked].reshape(-1, 1, 2)
+        self._previous_gray = gray
+        return self._box
+
+    @staticmethod
+    def _to_frame(box, scale, height, width):
+        top, right, bottom, left = (int(round(v / scale)) for v in box)
+        return (max(0, top), min(width, right), min(height, bottom), max(0, left))
+
+class PreviewRenderer:
+    """
+    Shows a small preview of the camera on the page, decoupled from frame scoring.
+
+    Frames are shrunk to max_width before the overlay is drawn, JPEG encoded once at
+    jpeg_quality and pushed at most max_fps times per second, so the preview stays cheap
+    next to the inference work.
+    """
+
+    def __init__(self, placeholder, max_fps=10, max_width=480, jpeg_quality=60):
+        self.placeholder = placeholder
+        self.min_interval = 1.0 / max_fps
+        self.max_width = max_width
+        self.jpeg_quality = jpeg_quality
+        self.frames_rendered = 0
+        self._last_render = 0.0
+
+    def render(self, frame, overlay=None):
+        """
+        Render the frame if the preview is due, returns whether it was pushed.
+        overlay is an optional dict with a face 'box' in (top, right, bottom, left) frame coordinates,
+        its 'box_color' and status 'lines' as (text, color) pairs.
+        """
+        now = time.monotonic()
+        if now - self._last_render < self.min_interval:
+            return False
+
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.max_width / float(width))
+        preview = frame if scale == 1.0 else cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        if preview is frame and overlay:
+            preview = frame.copy()
+
+        if overlay:
+            if overlay.get('box') is not None:
+                top, right, bottom, left = (int(v * scale) for v in overlay['box'])
+                cv2.rectangle(preview, (left, top), (right, bottom), overlay.get('box_color', (0, 255, 0)), 2)
+            for row, (text, color) in enumerate(overlay.get('lines', []), start=1):
+                cv2.putText(preview, text, (8, 20 * row), cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1)
+
+        success, encoded = cv2.imencode('.jpg', preview, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not success:
+            return False
+        self.placeholder.image(encoded.tobytes())
+        self.frames_rendered += 1
+        self._last_render = now
+        return True
+
+LIVENESS_MODES = ("either", "blink", "head-pose")
+
+LEFT_EYE = slice(36, 42)
+RIGHT_EYE = slice(42, 48)
+HEAD_MODEL_LANDMARKS = [30, 8, 36, 45, 48, 54]
+HEAD_MODEL_POINTS = np.array([
+    (0.0, 0.0, 0.0),
+    (0.0, -330.0, -65.0),
+    (-225.0, 170.0, -135.0),
+    (225.0, 170.0, -135.0),
+    (-150.0, -150.0, -125.0),
+    (150.0, -150.0, -125.0)
+], dtype=np.float64)
+
+def eye_aspect_ratio(eye):
+    """Height over width of one eye from its six landmarks, drops towards 0 while the eye is closed"""
+    vertical = np.linalg.norm(eye[1] - eye[5]) + np.linalg.norm(eye[2] - eye[4])
+    return vertical / (2.0 * np.linalg.norm(eye[0] - eye[3]))
+
+def head_yaw(points, frame_shape):
+    """Left/right rotation of the head in degrees, from solvePnP on six landmarks with an approximate camera"""
+    height, width = frame_shape[:2]
+    camera = np.array([[width, 0, width / 2], [0, width, height / 2], [0, 0, 1]], dtype=np.float64)
+    ok, rotation_vector, _ = cv2.solvePnP(HEAD_MODEL_POINTS, points[HEAD_MODEL_LANDMARKS], camera, np.zeros(4), flags=cv2.SOLVEPNP_ITERATIVE)
+    if not ok:
+        return None
+    rotation, _ = cv2.Rodrigues(rotation_vector)
+    angles = cv2.RQDecomp3x3(rotation)[0]
+    return angles[1]
+
+def analyze_face(rgb_frame, box):
+    """
+    Encode a located face and measure its liveness signals from a single landmark pass.
+
+    The 68 point landmarks are computed once and used both for the face descriptor and for the
+    eye aspect ratio and head yaw. Returns (encoding, eye_aspect_ratio, yaw).
+    """
+    top, right, bottom, left = box
+    shape = fr.api.pose_predictor_68_point(rgb_frame, dlib.rectangle(int(left), int(top), int(right), int(bottom)))
+    encoding = np.array(fr.api.face_encoder.compute_face_descriptor(rgb_frame, shape, 1))
+    points = np.array([(part.x, part.y) for part in shape.parts()], dtype=np.float64)
+    ear = (eye_aspect_ratio(points[LEFT_EYE]) + eye_aspect_ratio(points[RIGHT_EYE])) / 2.0
+    return encoding, ear, head_yaw(points, rgb_frame.shape)
+
+class LivenessCheck:
+    """
+    Looks for a blink and for head movement in the scored frames, so a printed photo or a still screen doesn't pass.
+
+    A blink is the eye aspect ratio falling under ear_threshold after the eyes were seen open, head
+    movement is the yaw spanning at least min_yaw_range degrees. The yaw is the median of the last
+    yaw_window estimates, so a turn has to be held over consecutive frames and a single bad landmark
+    fit can't pass it. mode "blink" or "head-pose" needs that signal, "either" accepts any of them.
+    """
+
+    def __init__(self, mode="either", ear_threshold=0.21, min_blinks=1, min_yaw_range=12.0, yaw_window=3):
+        if mode not in LIVENESS_MODES:
+            raise ValueError(f"Unknown liveness mode: {mode}")
+        self.mode = mode
+        self.ear_threshold = ear_threshold
+        self.min_blinks = min_blinks
+        self.min_yaw_range = min_yaw_range
+        self.blinks = 0
+        self._recent_yaws = deque(maxlen=yaw_window)
+        self.min_yaw = None
+        self.max_yaw = None
+        self._eyes_open = False
+
+    def update(self, ear, yaw):
+        if ear >= self.ear_threshold:
+            self._eyes_open = True
+        elif self._eyes_open:
+            self._eyes_open = False
+            self.blinks += 1
+        if yaw is None:
+            return
+        self._recent_yaws.append(yaw)
+        if len(self._recent_yaws) == self._recent_yaws.maxlen:
+            yaw = float(np.median(self._recent_yaws))
+            self.min_yaw = yaw if self.min_yaw is None else min(self.min_yaw, yaw)
+            self.max_yaw = yaw if self.max_yaw is None else max(self.max_yaw, yaw)
+
+    @property
+    def yaw_range(self):
+        return 0.0 if self.min_yaw is None else self.max_yaw - self.min_yaw
+
+    @property
+    def passed(self):
+        blinked = self.blinks >= self.min_blinks
+        turned = self.yaw_range >= self.min_yaw_range
+        if self.mode == "blink":
+            return blinked
+        if self.mode == "head-pose":
+            return turned
+        return blinked or turned
+
+def run_live_session(references, frame_source, policy=DEFAULT_MATCH_POLICY, decision_mode="sprt",
+                     matches_required=10, total_time=30, preview=None, on_error=None, liveness=None,
+                     sprt_alpha=0.001, sprt_beta=0.01, sprt_min_frames=3, sprt_min_reject_frames=30):
+    """
+    Score frames from frame_source against the references until every document is decided or total_time runs out.
+
+    Realtime sources (the webcam) are read on a capture thread and inference is paced by its measured
+    latency. Recorded sources are scored frame by frame on their own clock, so replaying a session
+    gives the same result every time. Returns the per-document 'results', the raw 'match_counts' and
+    sequential 'decisions', and the session 'stats' (frames read and scored, scored frames per second,
+    time to decision, wall and CPU seconds, detector runs and tracked frames).
+
+    With a LivenessCheck the frames are scored with analyze_face, and the session keeps going after
+    the documents are decided until liveness passes; 'liveness' is then whether it passed. Until it
+    passes every frame runs the detector, liveness is never fed from a tracked box.
+    A document with matches_required matching frames passes even if the sequential test rejected it.
+    The sprt_ arguments are the sequential test's false accept and false reject rates and its minimum
+    frames before accepting and before rejecting.
+    """
+    doc_types = references.doc_types
+    match_counts = np.zeros(len(doc_types), dtype=int)
+    sequential_test = None
+    if decision_mode == "sprt":
+        sequential_test = SequentialMatchTest(
+            len(doc_types), policy, alpha=sprt_alpha, beta=sprt_beta,
+            min_frames=sprt_min_frames, min_reject_frames=sprt_min_reject_frames
+        )
+    decisions = np.zeros(len(doc_types), dtype=int)
+    locator = FaceLocator()
+    overlay = None
+    frames_read = 0
+    frames_scored = 0
+    time_to_decision = None
+
+    if frame_source.realtime:
+        reader = LatestFrameReader(frame_source).start()
+        pacer = InferencePacer()
+        session_start = time.monotonic()
+        elapsed = lambda: time.monotonic() - session_start
+    else:
+        reader = frame_source
+        pacer = None
+        elapsed = frame_source.position
+
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+
+    try:
+        while elapsed() < total_time:
+            if not ((match_counts < matches_required) & (decisions == 0)).any():
+                if time_to_decision is None:
+                    time_to_decision = elapsed()
+                can_pass = ((decisions == 1) | (match_counts >= matches_required)).any()
+                if liveness is None or liveness.passed or not can_pass:
+                    break
+
+            ret, frame = reader.read()
+            if not ret:
+                break
+            frames_read += 1
+
+            if pacer is None or pacer.ready():
+                inference_start = time.monotonic()
+                try:
+                    frames_scored += 1
+                    face_locations = locator.locate(frame, detect=liveness is not None and not liveness.passed)
+
+                    if len(face_locations) != 1:
+                        status = "Ensure one face in frame" if len(face_locations) == 0 else "Multiple faces detected"
+                        overlay = {'lines': [(status, (0, 0, 255))]}
+                    else:
+                        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                        if liveness is None:
+                            face_encoding = fr.face_encodings(rgb_frame, face_locations)[0]
+                        else:
+                            face_encoding, ear, yaw = analyze_face(rgb_frame, face_locations[0])
+                            if locator.last_detected:
+                                liveness.update(ear, yaw)
+
+                        dist1, doc_distances, matched = references.score(face_encoding, policy)
+                        match_counts += matched & (match_counts < matches_required)
+                        if sequential_test is not None:
+                            decisions = sequential_test.update(dist1, doc_distances)
+
+                        lines = []
+                        for row, doc_type in enumerate(doc_types):
+                            color = (0, 255, 0) if matched[row] else (0, 0, 255)
+                            if decisions[row] == 1 or match_counts[row] >= matches_required:
+                                progress = "accepted"
+                            elif decisions[row] == -1:
+                                progress = "rejected"
+                            else:
+                                progress = f"{match_counts[row]}/{matches_required}"
+                            lines.append((f"{doc_type} {progress} D1:{dist1:.2f} D2:{doc_distances[row]:.2f}", color))
+                        if liveness is not None:
+                            if liveness.passed:
+                                lines.append(("Liveness confirmed", (0, 255, 0)))
+                            else:
+                                lines.append(("Blink or turn your head slightly", (0, 165, 255)))
+
+                        overlay = {
+                            'box': face_locations[0],
+                            'box_color': (0, 255, 0) if matched.any() else (0, 0, 255),
+                            'lines': lines
+                        }
+
+                except Exception as e:
+                    if on_error is not None:
+                        on_error(e)
+                    else:
+                        print(f"Error processing frame: {e}")
+                finally:
+                    if pacer is not None:
+                        pacer.record(inference_start, time.monotonic())
+
+            if preview is not None:
+                preview.render(frame, overlay)
+    finally:
+        if reader is not frame_source:
+            reader.stop()
+
+    wall_seconds = time.monotonic() - wall_start
+    results = {}
+    passed = (decisions == 1) | (match_counts >= matches_required)
+    for row, doc_type in enumerate(doc_types):
+        results[doc_type] = bool(passed[row])
+
+    return {
+        'results': results,
+        'match_counts': dict(zip(doc_types, match_counts.tolist())),
+        'decisions': dict(zip(doc_types, decisions.tolist())),
+        'liveness': None if liveness is None else liveness.passed,
+        'stats': {
+            'frames_read': frames_read,
+            'frames_scored': frames_scored,
+            'scored_fps': frames_scored / wall_seconds if wall_seconds > 0 else 0.0,
+            'time_to_decision': time_to_decision,
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': time.process_time() - cpu_start,
+            'detections': locator.detections,
+            'tracked_frames': locator.tracked_frames,
+            'blinks': None if liveness is None else liveness.blinks,
+            'yaw_range': None if liveness is None else liveness.yaw_range
+        }
+    }
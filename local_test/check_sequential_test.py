@@ -0,0 +1,38 @@
+"""Check that the live verification sequential test never accepts a document on frames the match policy rejects."""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from live_verification_utils import DEFAULT_MATCH_POLICY, SequentialMatchTest
+
+def accepted(profile_distance, document_distance, frames=100):
+    test = SequentialMatchTest(1, DEFAULT_MATCH_POLICY)
+    for _ in range(frames):
+        if test.update(profile_distance, np.array([document_distance]))[0] == 1:
+            return True
+    return False
+
+def main():
+    grid = np.round(np.arange(0.0, 1.01, 0.01), 2)
+    for profile_distance in grid:
+        for document_distance in grid:
+            if DEFAULT_MATCH_POLICY.matches(profile_distance, np.array([document_distance]))[0]:
+                continue
+            assert not accepted(profile_distance, document_distance), (profile_distance, document_distance)
+
+    rng = np.random.default_rng(0)
+    for _ in range(1000):
+        test = SequentialMatchTest(1, DEFAULT_MATCH_POLICY)
+        for _ in range(60):
+            profile_distance, document_distance = rng.uniform(0.0, 1.0, 2)
+            if DEFAULT_MATCH_POLICY.matches(profile_distance, np.array([document_distance]))[0]:
+                continue
+            assert test.update(profile_distance, np.array([document_distance]))[0] != 1, (profile_distance, document_distance)
+
+    assert accepted(0.40, 0.40)
+    print("No policy-mismatched pair was accepted")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Replay a recorded live verification session (a video file or a directory of frames) and print the result with the session stats."""
+import argparse
+import json
+import os
+import sys
+
+import cv2
+import face_recognition as fr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from live_verification_utils import LIVENESS_MODES, LivenessCheck, ReferenceSet, run_live_session
+from frame_sources import open_frame_source
+
+def load_and_encode(image_path):
+    img = cv2.imread(image_path)
+    img = cv2.flip(img, 1)
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    encodings = fr.face_encodings(rgb)
+    if len(encodings) == 0:
+        return None
+    return encodings[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("recording", help="video file or directory of frames")
+    parser.add_argument("profile", help="profile photo")
+    parser.add_argument("documents", nargs="+", help="document face images as doc_type=path")
+    parser.add_argument("--decision-mode", choices=("sprt", "fixed"), default="sprt")
+    parser.add_argument("--sprt-alpha", type=float, default=0.001, help="false accept rate of the sequential test")
+    parser.add_argument("--sprt-beta", type=float, default=0.01, help="false reject rate of the sequential test")
+    parser.add_argument("--sprt-min-frames", type=int, default=3)
+    parser.add_argument("--sprt-min-reject-frames", type=int, default=30)
+    parser.add_argument("--liveness", choices=LIVENESS_MODES + ("off",), default="off")
+    parser.add_argument("--realtime", action="store_true", help="play the recording at its own frame rate")
+    args = parser.parse_args()
+
+    profile_encoding = load_and_encode(args.profile)
+    if profile_encoding is None:
+        sys.exit("No face detected in the profile photo")
+
+    doc_encodings = {}
+    for document in args.documents:
+        doc_type, _, path = document.partition("=")
+        encoding = load_and_encode(path)
+        if encoding is None:
+            print(f"Skipping {doc_type}: no face detected")
+            continue
+        doc_encodings[doc_type] = encoding
+
+    source = open_frame_source(args.recording, realtime=args.realtime)
+    if not source.is_opened():
+        sys.exit(f"Could not open {args.recording}")
+    try:
+        liveness = None if args.liveness == "off" else LivenessCheck(args.liveness)
+        session = run_live_session(
+            ReferenceSet(profile_encoding, doc_encodings), source, decision_mode=args.decision_mode, liveness=liveness,
+            sprt_alpha=args.sprt_alpha, sprt_beta=args.sprt_beta,
+            sprt_min_frames=args.sprt_min_frames, sprt_min_reject_frames=args.sprt_min_reject_frames
+        )
+    finally:
+        source.release()
+
+    print(json.dumps(session, indent=2))
+
+if __name__ == "__main__":
+    main()
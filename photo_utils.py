@@ -1,10 +1,11 @@
 """Utility functions for the upload of photos extracted from the ID's. To store the photos in supabase bucket and table."""
 import streamlit as st
 from supabase_client import supabase, handle_auth_failure
+from embedding_utils import serialize_embedding, reference_embeddings
 import os
 import uuid
 
-def upload_picture(user_id, document_type, file):
+def upload_picture(user_id, document_type, file, embedding=None):
     try:
         session = supabase.auth.get_session()
         if not session or not session.user or session.user.id != user_id:
@@ -34,8 +35,11 @@ def upload_picture(user_id, document_type, file):
             "document_type": document_type,
             "file_path": file_path,
         }
+        if embedding is not None:
+            doc_data["face_embedding"] = serialize_embedding(embedding)
 
         response = supabase.table("user_pictures").insert(doc_data).execute()
+        st.session_state.pop('live_references', None)
 
         if hasattr(response, 'error') and response.error:
             st.error(f"Database record creation failed: {response.error.message}")
@@ -95,6 +99,8 @@ def delete_picture(doc_id, user_id, file_path):
             st.error(f"Failed to delete picture from storage: {storage_res['error']['message']}")
             return False
         print(f"Debug: Storage file {file_path} deleted successfully.")
+        reference_embeddings.invalidate(file_path)
+        st.session_state.pop('live_references', None)
 
         print(f"Debug: Attempting to delete DB record for doc_id: {doc_id}")
         response = supabase.table("user_pictures").delete().eq("doc_id", doc_id).eq("user_id", user_id).execute()
@@ -3,18 +3,11 @@ import google.generativeai as genai
 import json
 import os
 from dotenv import load_dotenv
+from verification_rules import local_verdict, number_verdict
 load_dotenv(".env")
-def configuration():
-    fetched_api_key = os.getenv("GOOGLE_API_KEY")
-    genai.configure(api_key=fetched_api_key)
 
-def verify_doc(doc_data, user_profile):
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        doc_str = json.dumps(doc_data, indent=2)
-        profile_str = json.dumps(user_profile, indent=2)
-        
-        prompt = """
+VERIFICATION_MODEL = 'gemini-1.5-flash'
+VERIFICATION_RULES = """
 You are an identity verification system. Compare the document information with the user profile 
 and determine if they belong to the same person. Follow these rules:
 0. Website doucment type should match document type.
@@ -54,7 +47,33 @@ and determine if they belong to the same person. Follow these rules:
    - Missing optional fields (address, phone, etc.)
    - Partial address matches (building name matches but flat number missing)
 
-DOCUMENT DATA:
+"""
+
+def configuration():
+    fetched_api_key = os.getenv("GOOGLE_API_KEY")
+    genai.configure(api_key=fetched_api_key)
+
+def normalize_verdict(result):
+    """Make sure a verdict begins with VALID or INVALID"""
+    result = str(result).strip()
+    if not (result.startswith("VALID") or result.startswith("INVALID")):
+        return "VALID" if "valid" in result.lower() else "INVALID: Could not determine"
+    return result
+
+def verify_doc(doc_data, user_profile, stats=None):
+    """Verify a document locally when the rules are clear cut, otherwise ask the model. stats counts this call's local decisions"""
+    verdict = number_verdict(doc_data, stats) or local_verdict(doc_data, user_profile, stats)
+    if verdict is not None:
+        return verdict
+    return verify_doc_with_model(doc_data, user_profile)
+
+def verify_doc_with_model(doc_data, user_profile):
+    try:
+        model = genai.GenerativeModel(VERIFICATION_MODEL)
+        doc_str = json.dumps(doc_data, indent=2)
+        profile_str = json.dumps(user_profile, indent=2)
+        
+        prompt = VERIFICATION_RULES + """DOCUMENT DATA:
 {doc_str}
 
 USER PROFILE:
@@ -69,10 +88,61 @@ Your verification response must begin with either "VALID" or "INVALID":
 """
         
         response = model.generate_content(prompt.format(doc_str=doc_str, profile_str=profile_str))
-        result = response.text.strip()
-        if not (result.startswith("VALID") or result.startswith("INVALID")):
-            return "VALID" if "valid" in result.lower() else "INVALID: Could not determine"
-        return result
+        return normalize_verdict(response.text)
         
     except Exception as e:
         return f"ERROR: {str(e)}"
+
+def verify_docs_batch(doc_data_list, user_profile, stats=None):
+    """
+    Verify several documents against the profile in a single request.
+
+    The rules and the profile are sent once with every document numbered by its position, and the
+    model answers with a JSON list of {"index", "result"} verdicts. Returns the verdicts in the order
+    of doc_data_list, documents missing from an unparsable or incomplete answer are verified one by
+    one. Documents the local rules decide are left out of the request, stats counts them for this call.
+    """
+    verdicts = [number_verdict(doc_data, stats) or local_verdict(doc_data, user_profile, stats) for doc_data in doc_data_list]
+    pending = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    if len(pending) <= 1:
+        for i in pending:
+            verdicts[i] = verify_doc_with_model(doc_data_list[i], user_profile)
+        return verdicts
+
+    try:
+        model = genai.GenerativeModel(VERIFICATION_MODEL)
+        docs_str = json.dumps([{"index": i, "document": doc_data_list[i]} for i in pending], indent=2)
+        profile_str = json.dumps(user_profile, indent=2)
+
+        prompt = VERIFICATION_RULES + f"""DOCUMENTS:
+{docs_str}
+
+USER PROFILE:
+{profile_str}
+
+Important: 
+- Verify every document on its own against the user profile
+- Focus on matching what's present in both documents
+- Don't penalize for missing optional fields
+- Be lenient with address/phone formatting
+
+Return ONLY a JSON list with one object per document, in this format:
+[{{"index": 0, "result": "VALID"}}, {{"index": 1, "result": "INVALID: [reason]"}}]
+Every result must begin with either "VALID" or "INVALID".
+"""
+
+        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+        json_str = response.text.strip().replace('```json', '').replace('```', '').strip()
+        for item in json.loads(json_str):
+            index = item.get("index") if isinstance(item, dict) else None
+            if isinstance(index, int) and index in pending and item.get("result"):
+                verdicts[index] = normalize_verdict(item["result"])
+    except Exception as e:
+        print(f"Debug: Batch verification failed, verifying documents one by one: {e}")
+
+    missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    if missing and len(missing) < len(pending):
+        print(f"Debug: Batch verification returned no verdict for documents {missing}, verifying them one by one")
+    for i in missing:
+        verdicts[i] = verify_doc_with_model(doc_data_list[i], user_profile)
+    return verdicts
@@ -0,0 +1,197 @@
+"""Local rules that decide the clear cut document verifications before they are sent to Gen-AI, following the same rules as the verification prompt."""
+import os
+import re
+import threading
+from datetime import datetime
+from document_validators import validate_document_number
+
+LOCAL_RULES_ENABLED = os.getenv("VERIFICATION_LOCAL_RULES", "1") != "0"
+NUMBER_VALIDATION_ENABLED = os.getenv("DOCUMENT_NUMBER_VALIDATION", "1") != "0"
+ADDRESS_OVERLAP = 0.8
+
+NAME_TITLES = {"mr", "mrs", "ms", "miss", "dr", "shri", "sri", "smt", "kumari", "km"}
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y/%m/%d")
+
+def document_kind(document_type):
+    """Map a website or extracted document type to aadhaar, pan, passport, driving_license or voter_id, None if unknown"""
+    if not document_type:
+        return None
+    text = str(document_type).lower()
+    if "aadha" in text or "adhar" in text:
+        return "aadhaar"
+    if "passport" in text:
+        return "passport"
+    if "voter" in text or "election" in text:
+        return "voter_id"
+    if "driv" in text or "licen" in text:
+        return "driving_license"
+    if re.search(r"\bpan\b", text):
+        return "pan"
+    return None
+
+def is_back_aadhaar(document_type):
+    return document_kind(document_type) == "aadhaar" and "back" in str(document_type).lower()
+
+def name_tokens(name):
+    """Lowercase words of a name without punctuation and titles like Mr or Smt"""
+    words = re.sub(r"[^a-z\s]", " ", str(name).lower()).split()
+    return [word for word in words if word not in NAME_TITLES]
+
+def compare_names(document_name, profile_name):
+    """Return "exact" or "variation" when the names are confidently the same person's, None when it needs a closer look"""
+    doc_tokens = name_tokens(document_name)
+    profile_tokens = name_tokens(profile_name)
+    if not doc_tokens or not profile_tokens:
+        return None
+    if doc_tokens == profile_tokens or sorted(doc_tokens) == sorted(profile_tokens):
+        return "exact"
+
+    if len(doc_tokens) == len(profile_tokens) and all(
+        a == b or (len(a) == 1 and b.startswith(a)) or (len(b) == 1 and a.startswith(b))
+        for a, b in zip(doc_tokens, profile_tokens)
+    ):
+        return "variation"
+
+    shorter, longer = sorted((doc_tokens, profile_tokens), key=len)
+    if len(shorter) >= 2 and shorter[0] == longer[0] and shorter[-1] == longer[-1] and set(shorter) <= set(longer):
+        return "variation"
+
+    return None
+
+def parse_date(value):
+    if not value:
+        return None
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text[:10], fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def address_overlap(document_address, profile_address):
+    """Share of the profile address words found in the document address"""
+    doc_words = set(re.sub(r"[^a-z0-9\s]", " ", str(document_address).lower()).split())
+    profile_words = set(re.sub(r"[^a-z0-9\s]", " ", str(profile_address).lower()).split())
+    if not profile_words:
+        return 0.0
+    return len(doc_words & profile_words) / len(profile_words)
+
+def pre_verify(doc_data, user_profile):
+    """
+    Decide a verification locally, returns the verdict or None when it should be left to the model.
+
+    Applies the prompt's rules where they leave no room for judgement: the website and extracted
+    document types must be the same kind, a Back Aadhaar card is checked on its address only, the
+    name and document number are required, and a date of birth present on both must be the same.
+    Names pass when they are equal after normalization or differ only by initials or missing middle
+    names. Anything else, a spelling difference or a nickname, goes to the model.
+    """
+    if not user_profile:
+        return None
+    info = doc_data.get("document_info", {})
+    additional = doc_data.get("additional_info", {})
+
+    website_kind = document_kind(info.get("website_document_type"))
+    extracted_kind = document_kind(info.get("document_type"))
+    if website_kind and extracted_kind and website_kind != extracted_kind:
+        return f"INVALID: Document type mismatch, expected {info.get('website_document_type')} but found {info.get('document_type')}"
+
+    if not website_kind or not extracted_kind:
+        return None
+
+    if is_back_aadhaar(info.get("document_type")):
+        if not additional.get("address"):
+            return "INVALID: Missing address"
+        if user_profile.get("address") and address_overlap(additional["address"], user_profile["address"]) >= ADDRESS_OVERLAP:
+            return "VALID"
+        return None
+
+    if not info.get("name"):
+        return "INVALID: Missing name"
+    if not info.get("document_number"):
+        return "INVALID: Missing document_number"
+
+    document_dob = info.get("date_of_birth")
+    profile_dob = parse_date(user_profile.get("dob"))
+    if document_dob and profile_dob:
+        parsed_dob = parse_date(document_dob)
+        if parsed_dob is not None and parsed_dob != profile_dob:
+            return "INVALID: Date of birth mismatch"
+        if parsed_dob is None:
+            year = re.fullmatch(r"\s*(\d{4})\s*", str(document_dob))
+            if not year:
+                return None
+            if int(year.group(1)) != profile_dob.year:
+                return "INVALID: Date of birth mismatch"
+
+    name_match = compare_names(info["name"], user_profile.get("name"))
+    if name_match == "exact":
+        return "VALID"
+    if name_match == "variation":
+        return "VALID with minor discrepancies: Name differs only by initials or middle names"
+    return None
+
+class RuleStats:
+    """Counts the verifications decided locally and the ones left to the model"""
+
+    def __init__(self):
+        self.decided = 0
+        self.deferred = 0
+        self._lock = threading.Lock()
+
+    def record(self, verdict):
+        with self._lock:
+            if verdict is None:
+                self.deferred += 1
+            else:
+                self.decided += 1
+
+    def avoided_percentage(self):
+        with self._lock:
+            total = self.decided + self.deferred
+            return 100.0 * self.decided / total if total else 0.0
+
+rule_stats = RuleStats()
+
+def number_verdict(doc_data, stats=None):
+    """
+    INVALID verdict for a document number malformed for its kind (see document_validators), None when
+    it is well formed, can't be checked offline or the check is turned off. Rejections are counted
+    like local_verdict's.
+    """
+    if not NUMBER_VALIDATION_ENABLED:
+        return None
+    try:
+        info = doc_data.get("document_info", {})
+        if is_back_aadhaar(info.get("document_type")):
+            return None
+        kind = document_kind(info.get("document_type")) or document_kind(info.get("website_document_type"))
+        well_formed, reason = validate_document_number(kind, info.get("document_number"))
+    except Exception as e:
+        print(f"Debug: Document number validation failed: {e}")
+        return None
+    if well_formed is not False:
+        return None
+    verdict = f"INVALID: Document number format, {reason}"
+    rule_stats.record(verdict)
+    if stats is not None:
+        stats.record(verdict)
+    return verdict
+
+def local_verdict(doc_data, user_profile, stats=None):
+    """
+    pre_verify with the outcome counted in the process wide rule_stats and in stats, the caller's own
+    RuleStats for one run. None when local rules are turned off.
+    """
+    if not LOCAL_RULES_ENABLED:
+        return None
+    try:
+        verdict = pre_verify(doc_data, user_profile)
+    except Exception as e:
+        print(f"Debug: Local verification rules failed: {e}")
+        verdict = None
+    rule_stats.record(verdict)
+    if stats is not None:
+        stats.record(verdict)
+    return verdict